@@ -2,58 +2,131 @@
 import logging
 import os
 import datetime
-import re
 
 from utils.cache_manager import move_to_cache, clean_cache
 from utils.file_utils import generate_temp_filename, generate_cache_filename
-from utils.video_utils import merge_audio_tracks, split_video, extract_audio, parse_segments, convert_to_9_16, add_subtitles
-from utils.whisper_utils import generate_subtitles
+from utils.video_utils import merge_audio_tracks, split_video, parse_segments, convert_to_9_16, add_subtitles, segment_window, count_audio_streams, resolve_transcribe_track, AudioPlan, keyframe_index, preceding_keyframe, render_clips, video_size, write_segment_metadata
+from utils.audio_utils import extract_pcm
+from utils.whisper_utils import generate_subtitles, generate_subtitles_batch, unload_model, save_transcript, load_transcript, write_clip_subtitles, transcribe_clip
 from utils.decision_maker import decide_clips
+from utils.candidate_ranker import rank_candidates
+from utils.clip_planner import plan_clips
+from utils.srt_utils import read_srt
+from utils.vad import detect_speech_file, save_vad_map, load_vad_map, report_skipped
 from utils.log_manager import log_info, log_attribute, log_warning, log_error
 
 CACHE_DIR = "data/cache"
 TEMP_DIR = "data/temp"
 
-def natural_sort_key(s):
-    return [int(c) if c.isdigit() else c.lower() for c in re.split(r'(\d+)', s)]
+# How clip subtitles are made in Step 5:
+#   "slice"        - cut and re-time the word-level transcript from Step 2 (no extra Whisper passes)
+#   "cascade"      - re-transcribe only the chosen clip windows with the more accurate SUBTITLE_MODEL
+#   "retranscribe" - extract each clip's audio and run Whisper on it again
+SUBTITLE_MODE = "cascade"
 
-def main(input_video):
+# The full-VOD transcript only feeds the clip decision, so a small fast model is enough there.
+# SUBTITLE_MODEL is used for the burned-in subtitles in "cascade" and "retranscribe" modes.
+TRANSCRIPT_MODEL = "small.en"
+SUBTITLE_MODEL = "medium.en"
+
+# ASR engine used for transcription (see utils/asr_backends.py): "whisper" or "faster-whisper" (int8 on CPU)
+ASR_BACKEND = "whisper"
+
+# Step 2 transcription: split the audio at silences and transcribe the windows in parallel.
+# Each worker loads its own model, so keep workers x model size within RAM.
+TRANSCRIBE_WORKERS = 2
+THREADS_PER_WORKER = None  # None divides the CPU cores evenly between workers
+
+# Mix the audio tracks while cutting each clip (Step 4) instead of writing a merged copy
+# of the whole VOD in Step 0
+DEFER_AUDIO_MERGE = True
+
+# Audio track to transcribe, read straight from the source video:
+#   None   - the merged mix of every track (as rendered in the clips)
+#   "auto" - the track with the most speech, e.g. the mic track
+#   0, 1.. - a specific audio track index
+TRANSCRIBE_TRACK = "auto"
+
+# Only send speech regions found by voice-activity detection to Whisper
+USE_VAD = True
+
+# Only the PRERANK_TOP_K most promising windows (speech rate, loudness, keywords) go to the LLM.
+# None sends the whole transcript.
+PRERANK_TOP_K = 12
+
+# Decode and transcribe the audio through an ffmpeg pipe a window at a time, so memory stays flat
+# however long the VOD is. Runs in one process and does not use VAD, parallel workers or checkpoints.
+STREAM_TRANSCRIPTION = False
+
+# Cut clips frame-accurately: re-encode only up to the first keyframe in each clip and copy the rest.
+# Off, clips are stream-copied from the keyframe before their start (up to a GOP early).
+# Only used by the "staged" RENDER_MODE; "fused" seeks frame-accurately anyway.
+SMART_CUT = True
+
+# How the final clips are rendered:
+#   "batch"  - like "fused", but clips close together share one ffmpeg call and one decode of the source
+#   "fused"  - seek, 9:16 scale/pad and subtitle burn in one ffmpeg call per clip, straight from the source
+#   "staged" - cut a segment (Step 4), convert it to 9:16, then burn the subtitles in (two encodes)
+RENDER_MODE = "batch"
+
+# ffmpeg renders run at the same time in "batch" and "fused" modes; the CPU cores are divided
+# between them with -threads so the machine is not oversubscribed
+RENDER_WORKERS = 3
+
+def clip_temp_files(i):
+    """Temporary subtitle and audio files of clip i."""
+    return os.path.join("data/temp/", f"audio_{i:02d}.srt"), os.path.join("data/temp", f"audio_{i:02d}.pcm")
+
+def clip_subtitles(i, segment, transcript, audio_file, clip_file, start=None, duration=None, mix_tracks=1, lead=0.0):
+    """Write the subtitles of clip i (per SUBTITLE_MODE) and return (srt path, temp audio path).
+
+    "retranscribe" transcribes the audio of clip_file, or of start..start+duration of it.
+    "slice" and "cascade" time the subtitles from the segment's start, or from `lead` seconds
+    before it when the clip's video actually starts there (a cut at the keyframe before the start).
+    """
+    temp_srt, temp_audio = clip_temp_files(i)
+    if SUBTITLE_MODE == "slice":
+        log_attribute(f"Slicing subtitles for segment {i} from the full transcript...")
+        start_seconds, duration = segment_window(segment)
+        write_clip_subtitles(transcript, start_seconds - lead, start_seconds + duration, temp_srt)
+    elif SUBTITLE_MODE == "cascade":
+        log_attribute(f"Transcribing segment {i} with {SUBTITLE_MODEL}...")
+        start_seconds, duration = segment_window(segment)
+        transcribe_clip(audio_file, start_seconds - lead, start_seconds + duration, temp_srt, SUBTITLE_MODEL, ASR_BACKEND)
+    else:
+        log_attribute(f"Re-generating subtitles for segment {i}...")
+        extract_pcm(clip_file, temp_audio, mix_tracks=mix_tracks, start=start, duration=duration)
+        generate_subtitles(temp_audio, TEMP_DIR, True, model_name=SUBTITLE_MODEL, backend=ASR_BACKEND)
+    return temp_srt, temp_audio
+
+def setup_logging():
     # Configure logging
     log_folder = "log"
     os.makedirs(log_folder, exist_ok=True)
     log_filename = os.path.join(log_folder, f"log_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
 
-    # Ensure cache folder exists
-    os.makedirs(CACHE_DIR, exist_ok=True)
-
-
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s',
         handlers=[logging.FileHandler(log_filename), logging.StreamHandler()]
     )    
-    
-    temp_video = generate_temp_filename(input_video, "merged", "mp4")
-    audio_file = generate_temp_filename(input_video, "audio", "mp3")
-    srt_file = generate_temp_filename(input_video, "audio", "srt")
-    decision_file = generate_temp_filename(input_video, "decision", "json")
-    
-    c_temp_video = generate_cache_filename(input_video, "merged", "mp4")  # Cache merged video
-    c_audio_file = generate_cache_filename(input_video, "audio", "mp3")  # Cache audio file
-    c_srt_file = generate_cache_filename(input_video, "audio", "srt")  # Cache SRT file
-    c_decision_file = generate_cache_filename(input_video, "decision", "json")  # Cache decision JSON
-    
 
-    output_dir = "data/out"
-    final_output_dir = "data/final"
+def prepare_audio(input_video):
+    """Steps 0 to 1.5: merge audio tracks, extract audio and find speech regions, reusing the cache."""
+    temp_video = generate_temp_filename(input_video, "merged", "mp4")
+    audio_file = generate_temp_filename(input_video, "audio", "pcm")
+    vad_file = generate_temp_filename(input_video, "vad", "json")
 
-    os.makedirs("data/temp", exist_ok=True)
-    os.makedirs(output_dir, exist_ok=True)
-    os.makedirs(final_output_dir, exist_ok=True)
+    c_temp_video = generate_cache_filename(input_video, "merged", "mp4")  # Cache merged video
+    c_audio_file = generate_cache_filename(input_video, "audio", "pcm")  # Cache audio file (16 kHz mono PCM)
+    c_vad_file = generate_cache_filename(input_video, "vad", "json")  # Cache speech regions
 
     # Step 0: Merge audio tracks
-    log_info("Step 0: merging audio tracks...")
-    if not os.path.exists(c_temp_video):
+    if DEFER_AUDIO_MERGE:
+        log_info("Step 0: audio tracks will be merged per clip, reading from the source")
+        temp_video = input_video
+    elif not os.path.exists(c_temp_video):
+        log_info("Step 0: merging audio tracks...")
         temp_video = merge_audio_tracks(input_video, temp_video)
         if temp_video != input_video:
             move_to_cache(temp_video)
@@ -61,73 +134,215 @@ def main(input_video):
         log_info(f"Using cached merged video: {temp_video}")   
         temp_video = c_temp_video 
     
-    # Step 1: Extract audio
+    # Step 1: Extract audio (one ffmpeg pass from the source straight to 16 kHz mono PCM)
     log_info("Step 1: extracting audio...")
     if not os.path.exists(c_audio_file):
-        extract_audio(temp_video, audio_file)
+        if TRANSCRIBE_TRACK is None:
+            extract_pcm(input_video, audio_file, mix_tracks=count_audio_streams(input_video))
+        else:
+            extract_pcm(input_video, audio_file, track=resolve_transcribe_track(input_video, TRANSCRIBE_TRACK))
         move_to_cache(audio_file)
     else:
         log_info(f"Using cached audio file: {audio_file}")
         audio_file = c_audio_file
 
     
+    # Step 1.5: Find speech regions
+    speech_regions = None
+    if USE_VAD and not STREAM_TRANSCRIPTION:
+        log_info("Step 1.5: detecting speech regions...")
+        if not os.path.exists(c_vad_file):
+            speech_regions, audio_duration = detect_speech_file(audio_file)
+            save_vad_map(speech_regions, audio_duration, vad_file)
+            move_to_cache(vad_file)
+        else:
+            log_info(f"Using cached speech regions: {vad_file}")
+            vad_file = c_vad_file
+            speech_regions, audio_duration = load_vad_map(vad_file)
+        report_skipped(speech_regions, audio_duration)
+
+    return temp_video, audio_file, vad_file, speech_regions
+
+def transcribe_inputs(input_videos):
+    """Run Step 2 for every input without a cached transcript in one batch, so all the
+    videos share one model and one scheduling queue. main() then picks the results up from the cache."""
+    setup_logging()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    os.makedirs(TEMP_DIR, exist_ok=True)
+
+    pending = [
+        input_video for input_video in input_videos
+        if not os.path.exists(generate_cache_filename(input_video, "audio", "srt"))
+        or not os.path.exists(generate_cache_filename(input_video, "transcript", "json"))
+    ]
+    if len(pending) < 2 or STREAM_TRANSCRIPTION:
+        return
+
+    audio_files, speech_regions_list = [], []
+    for input_video in pending:
+        _, audio_file, _, speech_regions = prepare_audio(input_video)
+        audio_files.append(audio_file)
+        speech_regions_list.append(speech_regions)
+
+    # Each video checkpoints its windows to its own file in the cache, as in main()
+    checkpoint_files = [generate_cache_filename(input_video, "transcript-checkpoint", "jsonl") for input_video in pending]
+
+    def cache_transcript(n, transcript):
+        # Cache every video as soon as it is done, so a crash later in the batch does not lose it
+        input_video = pending[n]
+        transcript_file = generate_temp_filename(input_video, "transcript", "json")
+        save_transcript(transcript, transcript_file)
+        move_to_cache(generate_temp_filename(input_video, "audio", "srt"))
+        move_to_cache(transcript_file)
+        if os.path.exists(checkpoint_files[n]): os.remove(checkpoint_files[n])
+
+        # Everything is in the cache now, so the temp copies can go
+        for description, ext in [("merged", "mp4"), ("audio", "pcm"), ("vad", "json"), ("audio", "srt"), ("transcript", "json")]:
+            temp_file = generate_temp_filename(input_video, description, ext)
+            if os.path.exists(temp_file) and os.path.exists(generate_cache_filename(input_video, description, ext)):
+                os.remove(temp_file)
+
+    log_info(f"Step 2: generating subtitles for {len(pending)} videos in one batch...")
+    generate_subtitles_batch(audio_files, TEMP_DIR, model_name=TRANSCRIPT_MODEL, workers=TRANSCRIBE_WORKERS, threads_per_worker=THREADS_PER_WORKER, speech_regions_list=speech_regions_list, backend=ASR_BACKEND, checkpoint_files=checkpoint_files, on_file_done=cache_transcript)
+
+def main(input_video):
+    setup_logging()
+
+    # Ensure cache folder exists
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    srt_file = generate_temp_filename(input_video, "audio", "srt")
+    transcript_file = generate_temp_filename(input_video, "transcript", "json")
+    decision_file = generate_temp_filename(input_video, "decision", "json")
+    
+    c_temp_video = generate_cache_filename(input_video, "merged", "mp4")  # Cache merged video
+    c_audio_file = generate_cache_filename(input_video, "audio", "pcm")  # Cache audio file (16 kHz mono PCM)
+    c_srt_file = generate_cache_filename(input_video, "audio", "srt")  # Cache SRT file
+    c_vad_file = generate_cache_filename(input_video, "vad", "json")  # Cache speech regions
+    c_transcript_file = generate_cache_filename(input_video, "transcript", "json")  # Cache word-level transcript
+    c_decision_file = generate_cache_filename(input_video, "decision", "json")  # Cache decision JSON
+    c_checkpoint_file = generate_cache_filename(input_video, "transcript-checkpoint", "jsonl")  # Finished transcription windows
+    c_keyframe_file = generate_cache_filename(input_video, "keyframes", "json")  # Keyframe index of the source video
+    
+
+    output_dir = "data/out"
+    final_output_dir = "data/final"
+
+    os.makedirs("data/temp", exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(final_output_dir, exist_ok=True)
+
+    # Steps 0 - 1.5: Merge audio tracks, extract audio, find speech regions
+    temp_video, audio_file, vad_file, speech_regions = prepare_audio(input_video)
+
     # Step 2: Generate subtitles
     log_info("Step 2: generating subtitles...")
-    if not os.path.exists(c_srt_file):
-        generate_subtitles(audio_file, TEMP_DIR)
+    if not os.path.exists(c_srt_file) or not os.path.exists(c_transcript_file):
+        # Finished windows are checkpointed straight into the cache so a crash can resume from them
+        transcript = generate_subtitles(audio_file, TEMP_DIR, model_name=TRANSCRIPT_MODEL, workers=TRANSCRIBE_WORKERS, threads_per_worker=THREADS_PER_WORKER, speech_regions=speech_regions, backend=ASR_BACKEND, checkpoint_file=c_checkpoint_file, streaming=STREAM_TRANSCRIPTION)
+        save_transcript(transcript, transcript_file)
         move_to_cache(srt_file)
+        move_to_cache(transcript_file)
+        if os.path.exists(c_checkpoint_file): os.remove(c_checkpoint_file)
     else:
         log_info(f"Using cached subtitles file: {srt_file}")
         srt_file = c_srt_file
+        transcript_file = c_transcript_file
+        transcript = load_transcript(transcript_file)
 
     # Step 3: Decide on clip segments
     log_info("Step 3: deciding on clip segments...")
     if not os.path.exists(c_decision_file):
-        decide_clips(srt_file, decision_file)
+        candidates = rank_candidates(transcript, audio_file, PRERANK_TOP_K) if PRERANK_TOP_K else None
+        decide_clips(srt_file, decision_file, candidate_windows=candidates)
         move_to_cache(decision_file)
     else:
         log_info(f"Using cached decision file: {decision_file}")
         decision_file = c_decision_file
 
-    # Step 4: Split video into segments
-    log_info("Step 4: splitting video into segments...")
-    timeframes = parse_segments(decision_file)
-    split_video(temp_video, output_dir, timeframes)
+    # Step 3.5: Clamp, snap and dedupe the decided clips so nothing redundant gets encoded
+    log_info("Step 3.5: planning clips...")
+    timeframes = plan_clips(parse_segments(decision_file), read_srt(srt_file))
 
     # Extract the base name from the input video file
     input_base_name = os.path.splitext(os.path.basename(input_video))[0]
 
-    # Step 5: Convert each segment to 9:16 format and add subtitles
-    segments = [seg for seg in os.listdir(output_dir) if seg.endswith('.mp4')]
-    segments.sort(key=natural_sort_key)
-    
-    for i, segment in enumerate(segments, start=1):
-        input_segment = os.path.join(output_dir, segment)
-        temp_9_16 = os.path.join(output_dir, f"9_16_{segment}")
-        final_output = os.path.join(final_output_dir, f"{input_base_name}_final_segment_{i:02d}.mp4")
+    # The clip audio is mixed to stereo and encoded once, in whichever step first encodes the clip
+    audio_plan = AudioPlan.from_source(temp_video)
 
-        log_attribute(f"Converting segment {i} to 9:16 format...")
-        convert_to_9_16(input_segment, temp_9_16)
+    if RENDER_MODE in ("batch", "fused"):
+        # Steps 4 - 5: render every clip from the source with a single encode, no intermediate files
+        log_info("Steps 4 - 5: rendering clips...")
+        size = video_size(temp_video)
+        clips, temp_files, failures = [], [], []
+        for i, segment in enumerate(timeframes, start=1):
+            start_seconds, duration = segment_window(segment)
+            final_output = os.path.join(final_output_dir, f"{input_base_name}_final_segment_{i:02d}.mp4")
+            temp_files += clip_temp_files(i)
 
-        log_attribute(f"Re-generating subtitles for segment {i}...")
-        temp_audio = os.path.join("data/temp", f"audio_{i:02d}.mp3")
-        temp_srt = os.path.join("data/temp/", f"audio_{i:02d}.srt")
-        extract_audio(temp_9_16, temp_audio)
-        generate_subtitles(temp_audio, TEMP_DIR, True)
+            try:
+                temp_srt, _ = clip_subtitles(i, segment, transcript, audio_file, temp_video, start_seconds, duration, max(1, len(audio_plan.streams)))
+            except Exception as e:
+                # Only this clip is skipped; the rest still get rendered
+                log_error(f"Failed to make subtitles for segment {i}: {e}")
+                failures.append((final_output, e))
+                continue
+            clips.append((final_output, start_seconds, duration, temp_srt))
+            write_segment_metadata(temp_video, output_dir, i, segment)
 
-        log_attribute(f"Adding subtitles to segment {i}...")
-        add_subtitles(temp_9_16, temp_srt, final_output)
+        # Output names are fixed above, so they do not depend on which render finishes first
+        failures += render_clips(temp_video, clips, audio_plan, size, RENDER_WORKERS, share_decode=(RENDER_MODE == "batch"))
 
         # Clean up temporary files
-        os.remove(temp_9_16)
-        os.remove(temp_audio)
-        os.remove(temp_srt)
-        os.remove(input_segment)
+        for temp_file in temp_files:
+            if os.path.exists(temp_file): os.remove(temp_file)
+    else:
+        # Step 4: Split video into segments
+        log_info("Step 4: splitting video into segments...")
+        # Subtitles made from the transcript need to know where a keyframe-snapped cut really starts
+        keyframes = keyframe_index(temp_video, c_keyframe_file) if SMART_CUT or SUBTITLE_MODE != "retranscribe" else None
+        split_video(temp_video, output_dir, timeframes, audio_plan, keyframes if SMART_CUT else None)
+
+        # Step 5: Convert each segment to 9:16 format and add subtitles. Segments are opened by the
+        # name split_video gave them, so leftovers in output_dir cannot shift clips and subtitles apart.
+        failures = []
+        for i, timeframe in enumerate(timeframes, start=1):
+            input_segment = os.path.join(output_dir, f"segment_{i}.mp4")
+            temp_9_16 = os.path.join(output_dir, f"9_16_segment_{i}.mp4")
+            final_output = os.path.join(final_output_dir, f"{input_base_name}_final_segment_{i:02d}.mp4")
+            temp_srt, temp_audio = clip_temp_files(i)
+
+            # Without smart cutting the stream-copied clip starts at the keyframe before its start
+            lead = 0.0
+            if keyframes is not None and not SMART_CUT:
+                start_seconds, _ = segment_window(timeframe)
+                lead = start_seconds - preceding_keyframe(keyframes, start_seconds)
+
+            try:
+                log_attribute(f"Converting segment {i} to 9:16 format...")
+                convert_to_9_16(input_segment, temp_9_16)
+
+                clip_subtitles(i, timeframe, transcript, audio_file, temp_9_16, lead=lead)
+
+                log_attribute(f"Adding subtitles to segment {i}...")
+                add_subtitles(temp_9_16, temp_srt, final_output)
+            except Exception as e:
+                log_error(f"Failed to render segment {i}: {e}")
+                failures.append((final_output, e))
+
+            # Clean up temporary files
+            for temp_file in (temp_9_16, temp_audio, temp_srt, input_segment):
+                if temp_file and os.path.exists(temp_file): os.remove(temp_file)
+
+    if failures:
+        log_warning(f"{len(failures)} of {len(timeframes)} clips failed to render: {', '.join(os.path.basename(f) for f, _ in failures)}")
 
     # Move files to cache instead of deleting
     if temp_video != c_temp_video and temp_video != input_video: os.remove(temp_video)
     if audio_file != c_audio_file: os.remove(audio_file)
     if srt_file != c_srt_file: os.remove(srt_file)
+    if speech_regions is not None and vad_file != c_vad_file: os.remove(vad_file)
+    if transcript_file != c_transcript_file: os.remove(transcript_file)
     if decision_file != c_decision_file: os.remove(decision_file)
     
     # Clean up old files from the cache if needed
@@ -140,11 +355,18 @@ if __name__ == "__main__":
     # #input_video = r"data/input/test2.mp4"
     # main(input_video)
     
-    for input in [
+    input_videos = [
         r"A:\Projects\The Video Center\data\outputs\RAW__09-29-24__[09]\[VGL]-[EOW]-RAW__09-29-24__[09]-1.mp4", 
         r"A:\Projects\The Video Center\data\outputs\RAW__09-29-24__[09]\[VGL]-[EOW]-RAW__09-29-24__[09]-2.mp4", 
         r"A:\Projects\The Video Center\data\outputs\RAW__09-29-24__[09]\[VGL]-[EOW]-RAW__09-29-24__[09]-3.mp4",
         r"A:\Projects\The Video Center\data\outputs\RAW__09-30-24__[20]\[VGL]-[EPM]-RAW__09-30-24__[20]-1.mp4",
         r"A:\Projects\The Video Center\data\outputs\RAW__09-30-24__[20]\[VGL]-[EPM]-RAW__09-30-24__[20]-2.mp4",
-        ]:
-        main(input)
\ No newline at end of file
+        ]
+
+    # Transcribe all the parts together first; each main() then finds its transcript in the cache
+    transcribe_inputs(input_videos)
+    for input in input_videos:
+        main(input)
+
+    # Models stay loaded across the batch; release them once every video is done
+    unload_model()
\ No newline at end of file
@@ -0,0 +1,80 @@
+# asr_benchmark.py
+# Compare ASR backends on the same audio: real-time factor and word-timestamp drift
+# against the first backend in the list (the reference).
+import os
+import sys
+import time
+import difflib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.whisper_utils import get_model, transcribe, unload_model
+from utils.audio_utils import load_pcm, SAMPLE_RATE
+
+def words_of(result):
+    return [word for segment in result['segments'] for word in segment.get('words', [])]
+
+def normalize(word):
+    return ''.join(c for c in word.lower() if c.isalnum())
+
+def timestamp_drift(reference, candidate):
+    """Match the two word sequences by text and measure how far the matched word timings move."""
+    ref_words, cand_words = words_of(reference), words_of(candidate)
+    matcher = difflib.SequenceMatcher(a=[normalize(w['word']) for w in ref_words],
+                                      b=[normalize(w['word']) for w in cand_words],
+                                      autojunk=False)
+    drifts = []
+    for block in matcher.get_matching_blocks():
+        for k in range(block.size):
+            ref, cand = ref_words[block.a + k], cand_words[block.b + k]
+            drifts.append(max(abs(ref['start'] - cand['start']), abs(ref['end'] - cand['end'])))
+
+    if not drifts:
+        return {"matched": 0, "match_rate": 0.0, "mean": None, "p95": None, "max": None}
+    drifts.sort()
+    return {
+        "matched": len(drifts),
+        "match_rate": len(drifts) / max(len(ref_words), 1),
+        "mean": sum(drifts) / len(drifts),
+        "p95": drifts[int(0.95 * (len(drifts) - 1))],
+        "max": drifts[-1],
+    }
+
+def benchmark(audio_file, backends, model_name="medium.en"):
+    audio = load_pcm(audio_file)
+    duration = len(audio) / SAMPLE_RATE
+    print(f"Audio: {audio_file} ({duration:.1f}s)")
+
+    reference = None
+    for backend in backends:
+        load_start = time.perf_counter()
+        get_model(model_name, backend=backend)
+        load_time = time.perf_counter() - load_start
+
+        start = time.perf_counter()
+        result = transcribe(audio, model_name, backend)
+        elapsed = time.perf_counter() - start
+        unload_model(backend=backend)
+
+        line = f"{backend:>15}: load {load_time:6.1f}s, transcribe {elapsed:7.1f}s, RTF {elapsed / duration:.3f}, words {len(words_of(result))}"
+        if reference is None:
+            reference = result
+            line += " (reference)"
+        else:
+            drift = timestamp_drift(reference, result)
+            if drift["matched"]:
+                line += (f", matched {drift['match_rate']:.0%}, drift mean {drift['mean'] * 1000:.0f}ms"
+                         f" p95 {drift['p95'] * 1000:.0f}ms max {drift['max'] * 1000:.0f}ms")
+            else:
+                line += ", no matching words"
+        print(line)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python asr_benchmark.py audio_file [model_name] [backend ...]")
+        sys.exit(1)
+
+    audio_file = sys.argv[1]
+    model_name = sys.argv[2] if len(sys.argv) > 2 else "medium.en"
+    backends = sys.argv[3:] or ["whisper", "faster-whisper"]
+    benchmark(audio_file, backends, model_name)
@@ -0,0 +1,41 @@
+# prompt_compaction_benchmark.py
+# Measure how many prompt tokens the compact transcript encoding saves over raw SRT,
+# and optionally the end-to-end decision time of both on the same VOD.
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import decision_maker
+from utils.srt_utils import read_srt, format_cues, merge_utterances, format_compact
+
+def measure_tokens(srt_file):
+    cues = read_srt(srt_file)
+    raw_tokens = decision_maker.estimate_tokens(format_cues(cues), decision_maker.chars_per_token("srt"))
+    compact_tokens = decision_maker.estimate_tokens(format_compact(merge_utterances(cues)), decision_maker.chars_per_token("compact"))
+    print(f"Cues: {len(cues)}")
+    print(f"Raw SRT transcript:     {raw_tokens:8d} tokens")
+    print(f"Compact transcript:     {compact_tokens:8d} tokens")
+    print(f"Reduction:              {1 - compact_tokens / max(raw_tokens, 1):8.1%}")
+
+def measure_decision_time(srt_file):
+    timings = {}
+    for compact in (False, True):
+        label = "compact" if compact else "raw SRT"
+        # Keep the response cache out of the measurement
+        decision_maker.LLM_CACHE_DIR = os.path.join("data/temp", f"llm-benchmark-{int(time.time())}")
+        start = time.perf_counter()
+        decision_maker.decide_clips(srt_file, os.path.join("data/temp", f"benchmark-decision-{label}.json"), compact=compact)
+        timings[label] = time.perf_counter() - start
+        print(f"{label:>8}: decision step took {timings[label]:.1f}s")
+    print(f"Decision time change: {timings['compact'] / timings['raw SRT'] - 1:+.1%}")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python prompt_compaction_benchmark.py srt_file [--run]")
+        sys.exit(1)
+
+    measure_tokens(sys.argv[1])
+    if "--run" in sys.argv:
+        measure_decision_time(sys.argv[1])
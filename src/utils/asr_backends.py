@@ -0,0 +1,78 @@
+try:
+    from utils.log_manager import log_info, log_attribute, log_warning, log_error
+except ImportError:
+    from log_manager import log_info, log_attribute, log_warning, log_error
+
+# Every backend loads a model and turns 16 kHz audio (a file path or float32 array) into the
+# same result dict openai-whisper's transcribe returns:
+#   {"text": ..., "language": ..., "segments": [{"id", "start", "end", "text", "words": [{"word", "start", "end", "probability"}]}]}
+# so the SRT writer, the transcript slicing and the window stitching work with any of them.
+
+class WhisperBackend:
+    """openai-whisper running in PyTorch (fp32 on CPU)."""
+    name = "whisper"
+    default_compute_type = "float32"
+
+    def load(self, model_name, device, compute_type):
+        import whisper
+        return whisper.load_model(model_name, device=device)
+
+    def transcribe(self, model, audio, verbose=None, batch_size=1, initial_prompt=None):
+        # openai-whisper has no batched decoder that keeps word timestamps, so batch_size is ignored
+        return model.transcribe(audio, verbose=verbose, language='en', word_timestamps=True, task="transcribe", initial_prompt=initial_prompt)
+
+class FasterWhisperBackend:
+    """faster-whisper (CTranslate2), which can run the same checkpoints int8-quantized on CPU."""
+    name = "faster-whisper"
+    default_compute_type = "int8"
+
+    def load(self, model_name, device, compute_type):
+        from faster_whisper import WhisperModel
+        return WhisperModel(model_name, device=device, compute_type=compute_type)
+
+    def transcribe(self, model, audio, verbose=None, batch_size=1, initial_prompt=None):
+        if batch_size > 1:
+            # Decode batch_size 30 s chunks of the audio at once
+            from faster_whisper import BatchedInferencePipeline
+            model = BatchedInferencePipeline(model=model)
+            segments, info = model.transcribe(audio, language='en', word_timestamps=True, task="transcribe", batch_size=batch_size, initial_prompt=initial_prompt)
+        else:
+            segments, info = model.transcribe(audio, language='en', word_timestamps=True, task="transcribe", initial_prompt=initial_prompt)
+
+        result_segments = []
+        for segment in segments:  # A generator; decoding happens while we iterate
+            if verbose:
+                log_info(f"[{segment.start:.2f} --> {segment.end:.2f}] {segment.text}")
+            result_segments.append({
+                'id': len(result_segments),
+                'seek': segment.seek,
+                'start': segment.start,
+                'end': segment.end,
+                'text': segment.text,
+                'tokens': list(segment.tokens),
+                'temperature': segment.temperature,
+                'avg_logprob': segment.avg_logprob,
+                'compression_ratio': segment.compression_ratio,
+                'no_speech_prob': segment.no_speech_prob,
+                'words': [
+                    {'word': word.word, 'start': word.start, 'end': word.end, 'probability': word.probability}
+                    for word in (segment.words or [])
+                ],
+            })
+
+        return {
+            'text': ''.join(segment['text'] for segment in result_segments),
+            'segments': result_segments,
+            'language': info.language,
+        }
+
+BACKENDS = {
+    WhisperBackend.name: WhisperBackend(),
+    FasterWhisperBackend.name: FasterWhisperBackend(),
+}
+
+def get_backend(name):
+    """Look up an ASR backend by name."""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown ASR backend: {name} (available: {', '.join(BACKENDS)})")
+    return BACKENDS[name]
@@ -0,0 +1,92 @@
+import subprocess
+
+import numpy as np
+
+try:
+    from utils.log_manager import log_info, log_attribute, log_warning, log_error
+except ImportError:
+    from log_manager import log_info, log_attribute, log_warning, log_error
+
+SAMPLE_RATE = 16000  # Whisper always works on 16 kHz mono audio
+
+# Audio for the ASR is kept as raw .pcm files: 16 kHz mono signed 16-bit little-endian, no header.
+# They can be read (or windowed) directly with numpy, without running ffmpeg again.
+
+def is_raw_pcm(path):
+    return path.lower().endswith('.pcm')
+
+def pcm_command(input_file, start=None, duration=None, track=None, mix_tracks=1, output='-'):
+    """ffmpeg command that decodes the input's audio to 16 kHz mono s16le PCM in one pass.
+
+    Optionally only start..start+duration seconds, only audio track number `track`, or all
+    `mix_tracks` audio tracks merged and downmixed. Writes to stdout unless output is given.
+    """
+    cmd = ['ffmpeg', '-nostdin', '-v', 'error']
+    if output != '-':
+        cmd += ['-y']
+    if start is not None:
+        cmd += ['-ss', str(start)]
+    cmd += ['-i', input_file]
+    if track is not None:
+        cmd += ['-map', f'0:a:{track}']
+    elif mix_tracks > 1:
+        cmd += ['-filter_complex', f'amerge=inputs={mix_tracks}']
+    if duration is not None:
+        cmd += ['-t', str(duration)]
+    cmd += [
+        '-vn',
+        '-f', 's16le',
+        '-ac', '1',
+        '-ar', str(SAMPLE_RATE),
+        output
+    ]
+    return cmd
+
+def extract_pcm(input_file, pcm_path, track=None, mix_tracks=1, start=None, duration=None):
+    """Write the input's audio (or start..start+duration of it) as a raw 16 kHz mono .pcm file
+    with a single ffmpeg call."""
+    subprocess.run(pcm_command(input_file, start, duration, track, mix_tracks, output=pcm_path), check=True)
+    log_attribute(f"Extracted 16 kHz mono PCM to {pcm_path}")
+    return pcm_path
+
+def load_pcm(input_file, start=None, duration=None, track=None):
+    """Load the audio of a media file or raw .pcm file (or a window of it) as a float32 16 kHz mono array."""
+    if is_raw_pcm(input_file):
+        offset = int((start or 0) * SAMPLE_RATE)
+        count = -1 if duration is None else int(duration * SAMPLE_RATE)
+        data = np.fromfile(input_file, dtype=np.int16, count=count, offset=offset * 2)
+        return data.astype(np.float32) / 32768.0
+
+    result = subprocess.run(pcm_command(input_file, start, duration, track), capture_output=True, check=True)
+    data = result.stdout[:len(result.stdout) - len(result.stdout) % 2]
+    return np.frombuffer(data, np.int16).astype(np.float32) / 32768.0
+
+def pcm_stream(input_file, chunk_seconds):
+    """Yield the audio of input_file as float32 chunks of chunk_seconds, so the whole waveform
+    is never in memory at once. Raw .pcm files are read directly; anything else is decoded
+    by ffmpeg through a pipe."""
+    chunk_bytes = int(chunk_seconds * SAMPLE_RATE) * 2
+
+    if is_raw_pcm(input_file):
+        with open(input_file, 'rb') as f:
+            while True:
+                data = f.read(chunk_bytes)
+                if not data:
+                    break
+                data = data[:len(data) - len(data) % 2]
+                yield np.frombuffer(data, np.int16).astype(np.float32) / 32768.0
+        return
+
+    process = subprocess.Popen(pcm_command(input_file), stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            if not data:
+                break
+            data = data[:len(data) - len(data) % 2]
+            yield np.frombuffer(data, np.int16).astype(np.float32) / 32768.0
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
@@ -0,0 +1,104 @@
+import re
+
+import numpy as np
+
+try:
+    from utils.log_manager import log_info, log_attribute, log_warning, log_error
+    from utils.audio_utils import pcm_stream, SAMPLE_RATE
+except ImportError:
+    from log_manager import log_info, log_attribute, log_warning, log_error
+    from audio_utils import pcm_stream, SAMPLE_RATE
+
+WINDOW_SECONDS = 45       # Length of each scored window (clips are 30-60 s)
+STEP_SECONDS = 15         # Hop between windows
+CONTEXT_SECONDS = 30      # Transcript kept on each side of a chosen window so the LLM can pick the exact clip
+
+# Phrases that tend to mark exciting moments (the decision prompt itself calls out "boss" and "oh my god")
+KEYWORDS = [
+    "oh my god", "oh my gosh", "omg", "boss", "let's go", "lets go", "no way", "what the", "holy",
+    "wow", "yes", "no no", "dude", "insane", "crazy", "finally", "run", "help", "kill", "died", "dead",
+]
+
+# How much each signal counts towards a window's score (signals are z-scored first)
+WEIGHTS = {
+    "speech_rate": 1.0,
+    "loudness": 1.0,
+    "keywords": 1.5,
+}
+
+def loudness_per_second(audio_file):
+    """RMS loudness in dB for every second of the audio, read in bounded-memory chunks."""
+    levels = []
+    for chunk in pcm_stream(audio_file, 60):
+        seconds = len(chunk) // SAMPLE_RATE
+        if seconds == 0:
+            continue
+        frames = chunk[:seconds * SAMPLE_RATE].reshape(seconds, SAMPLE_RATE)
+        levels.extend(20 * np.log10(np.sqrt(np.mean(frames ** 2, axis=1)) + 1e-10))
+    return np.array(levels, dtype=np.float32)
+
+def _zscore(values):
+    values = np.asarray(values, dtype=np.float32)
+    std = values.std()
+    return (values - values.mean()) / std if std > 0 else np.zeros_like(values)
+
+def score_windows(transcript, loudness=None):
+    """Score sliding windows over the VOD. Returns a list of (start, end, score) sorted by time."""
+    words = [word for segment in transcript['segments'] for word in segment.get('words', [])]
+    if not words:
+        return []
+    duration = max(words[-1]['end'], len(loudness) if loudness is not None else 0)
+
+    keyword_pattern = re.compile(r"\b(" + "|".join(re.escape(k) for k in KEYWORDS) + r")\b")
+    starts = np.array([word['start'] for word in words])
+
+    windows, rates, levels, keyword_counts = [], [], [], []
+    for start in np.arange(0, max(duration - WINDOW_SECONDS, 0) + STEP_SECONDS, STEP_SECONDS):
+        end = start + WINDOW_SECONDS
+        lo, hi = np.searchsorted(starts, start), np.searchsorted(starts, end)
+        text = ''.join(word['word'] for word in words[lo:hi]).lower()
+
+        windows.append((float(start), float(end)))
+        rates.append((hi - lo) / WINDOW_SECONDS)
+        keyword_counts.append(len(keyword_pattern.findall(text)) + text.count('!'))
+        if loudness is not None and int(start) < len(loudness):
+            # Peaks matter more than the average: shouting, explosions, music stings
+            levels.append(np.percentile(loudness[int(start):int(end)], 90))
+        else:
+            levels.append(0.0)
+
+    scores = (WEIGHTS["speech_rate"] * _zscore(rates)
+              + WEIGHTS["loudness"] * _zscore(levels)
+              + WEIGHTS["keywords"] * _zscore(keyword_counts))
+    return [(start, end, float(score)) for (start, end), score in zip(windows, scores)]
+
+def rank_candidates(transcript, audio_file=None, top_k=10):
+    """Pick the top_k best non-overlapping windows and return them, padded with context and
+    merged where they touch, as (start, end) ranges for the LLM to look at."""
+    loudness = loudness_per_second(audio_file) if audio_file else None
+    scored = score_windows(transcript, loudness)
+    if not scored:
+        return []
+
+    chosen = []
+    for start, end, score in sorted(scored, key=lambda w: w[2], reverse=True):
+        if any(start < c_end and end > c_start for c_start, c_end, _ in chosen):
+            continue
+        chosen.append((start, end, score))
+        if len(chosen) >= top_k:
+            break
+
+    ranges = []
+    for start, end, score in sorted(chosen):
+        start, end = max(0.0, start - CONTEXT_SECONDS), end + CONTEXT_SECONDS
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+
+    covered = sum(end - start for start, end in ranges)
+    total = scored[-1][1]
+    log_info(f"Pre-ranking: sending {len(chosen)} candidate windows ({covered:.0f}s of {total:.0f}s) to the LLM")
+    for start, end, score in sorted(chosen):
+        log_attribute(f"Candidate {start:.0f}s - {end:.0f}s (score {score:.2f})")
+    return ranges
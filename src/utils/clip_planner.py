@@ -0,0 +1,91 @@
+try:
+    from utils.log_manager import log_info, log_attribute, log_warning, log_error
+    from utils.srt_utils import parse_timestamp, format_timestamp
+except ImportError:
+    from log_manager import log_info, log_attribute, log_warning, log_error
+    from srt_utils import parse_timestamp, format_timestamp
+
+# Turns the clips the LLM picked into the list that actually gets rendered: every clip within
+# the duration rules, starting and ending on subtitle cue boundaries, and no two clips showing
+# the same part of the video (the chunks overlap, so the same moment is often picked twice).
+
+MIN_CLIP_SECONDS = 30
+MAX_CLIP_SECONDS = 59
+MERGE_SLACK_SECONDS = 5   # Clips overlapping by less than this are both kept
+
+def virality(segment):
+    try:
+        return int(segment.get('virality', 0))
+    except (TypeError, ValueError):
+        return 0
+
+def clamp_interval(start, end, video_end=None):
+    """Stretch clips shorter than MIN_CLIP_SECONDS and cut ones longer than MAX_CLIP_SECONDS,
+    keeping the start (the hook) where it is unless the video ends first."""
+    start = max(0.0, start)
+    end = min(max(end, start + MIN_CLIP_SECONDS), start + MAX_CLIP_SECONDS)
+    if video_end is not None and end > video_end:
+        end = video_end
+        start = max(0.0, min(start, end - MIN_CLIP_SECONDS))
+    return start, end
+
+def snap_interval(start, end, cues):
+    """Move start back to the start of the cue it falls in, and end to the cue end closest to it
+    that still keeps the clip within MIN_CLIP_SECONDS..MAX_CLIP_SECONDS."""
+    for cue in cues:
+        if cue['end'] > start:
+            if cue['start'] <= start and start - cue['start'] <= MAX_CLIP_SECONDS - MIN_CLIP_SECONDS:
+                start = cue['start']
+            break
+    ends = [cue['end'] for cue in cues if start + MIN_CLIP_SECONDS <= cue['end'] <= start + MAX_CLIP_SECONDS]
+    if ends:
+        end = min(ends, key=lambda cue_end: abs(cue_end - end))
+    else:
+        end = min(max(end, start + MIN_CLIP_SECONDS), start + MAX_CLIP_SECONDS)
+    return start, end
+
+def plan_clips(segments, cues, video_end=None):
+    """Normalize the decided segments into a sorted plan without redundant clips.
+
+    Overlapping clips are merged when the union still fits in MAX_CLIP_SECONDS, otherwise
+    only the one with the higher virality is kept. Each returned segment keeps its LLM fields,
+    with the timestamp rewritten to the final interval.
+    """
+    if video_end is None and cues:
+        video_end = cues[-1]['end']
+
+    clips = []
+    for segment in segments:
+        try:
+            start, end = parse_timestamp(segment['timestamp'])
+        except (KeyError, ValueError) as e:
+            log_warning(f"Dropping segment with unreadable timestamp {segment.get('timestamp')!r}: {e}")
+            continue
+        if end <= start:
+            log_warning(f"Dropping segment with empty interval {segment.get('timestamp')!r}")
+            continue
+        start, end = snap_interval(*clamp_interval(start, end, video_end), cues)
+        clips.append([start, end, segment])
+
+    # Highest virality first, so a clip only ever gives way to a better one
+    plan = []
+    for start, end, segment in sorted(clips, key=lambda c: virality(c[2]), reverse=True):
+        overlapping = [p for p in plan if min(end, p[1]) - max(start, p[0]) > MERGE_SLACK_SECONDS]
+        if not overlapping:
+            plan.append([start, end, segment])
+            continue
+        kept = overlapping[0]
+        merged_start, merged_end = min(start, kept[0]), max(end, kept[1])
+        if len(overlapping) == 1 and merged_end - merged_start <= MAX_CLIP_SECONDS:
+            kept[0], kept[1] = snap_interval(merged_start, merged_end, cues)
+            log_attribute(f"Merged \"{segment.get('title', '')}\" into \"{kept[2].get('title', '')}\"")
+        else:
+            log_attribute(f"Dropped \"{segment.get('title', '')}\" (overlaps a clip with higher virality)")
+
+    plan.sort(key=lambda p: p[0])
+    planned = []
+    for start, end, segment in plan:
+        segment = dict(segment, timestamp=f"{format_timestamp(start)} --> {format_timestamp(end)}")
+        planned.append(segment)
+    log_info(f"Clip plan: {len(planned)} clips from {len(segments)} decided segments")
+    return planned
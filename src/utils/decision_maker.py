@@ -1,28 +1,319 @@
+import os
 import json
-from langchain_ollama import OllamaLLM
+import math
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from langchain_ollama import ChatOllama
 from langchain_core.prompts import ChatPromptTemplate
 try:
     # When running from the root of the project
     from utils.log_manager import log_info, log_attribute, log_warning, log_error
+    from utils.srt_utils import parse_srt, format_cues, merge_utterances, format_compact, parse_timestamp, snap_to_cues, format_timestamp
+    from utils.json_salvage import parse_object_list
 except ImportError:
     # When running directly
     from log_manager import log_info, log_attribute, log_warning, log_error
+    from srt_utils import parse_srt, format_cues, merge_utterances, format_compact, parse_timestamp, snap_to_cues, format_timestamp
+    from json_salvage import parse_object_list
 
-def chunk_transcript(transcript, chunk_size):
-    words = transcript.split()
-    for i in range(0, len(words), chunk_size):
-        yield ' '.join(words[i:i + chunk_size])
+# Parallel request slots of the Ollama server, as configured with OLLAMA_NUM_PARALLEL (Ollama's
+# own default is 4 when memory allows). Each slot keeps its own KV cache.
+SERVER_SLOTS = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+
+# How many chunks may be waiting on Ollama at once. Extra requests would only queue on the server.
+MAX_IN_FLIGHT = SERVER_SLOTS
+
+NUM_CTX = 8196            # Context window the model is run with
+
+MODEL_NAME = "gemma2:27b"
+MODEL_PARAMS = {
+    "temperature": 0.6,       # Lower temperature for more deterministic responses
+    "top_k": 30,              # Narrow down the token selection to reduce randomness
+    "top_p": 0.85,            # Adjust nucleus sampling for more focused results
+    "repeat_penalty": 1.1,    # Penalize token repetition to avoid loops
+    "mirostat": 2,            # Enable Mirostat for dynamic perplexity control
+    "mirostat_eta": 0.1,      # Set the learning rate for Mirostat
+    "mirostat_tau": 5.0,      # Target perplexity for Mirostat to control randomness
+    "num_ctx": NUM_CTX,       # Maximum context tokens for better understanding of inputs
+    # "stop": ["\n", "End"]  # Stop tokens to prevent over-generation and hallucinations
+}
+
+# Ollama constrains the answer to this JSON schema (structured outputs), so it is always an
+# array of clip objects with these fields
+CLIP_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "timestamp": {"type": "string"},
+            "description": {"type": "string"},
+            "content": {"type": "string"},
+            "virality": {"type": "integer", "minimum": 1, "maximum": 100},
+            "title": {"type": "string"},
+        },
+        "required": ["timestamp", "description", "content", "virality", "title"],
+    },
+}
+MAX_CHUNK_RETRIES = 2     # Extra attempts for a chunk whose answer failed or could not be fully parsed
+
+# Keep the model (and the KV cache of the shared system prompt) loaded between chunks and runs
+KEEP_ALIVE = "30m"
+
+# Responses are cached per chunk, keyed by everything that affects the answer,
+# so re-runs and runs that crashed halfway only pay for chunks that changed
+LLM_CACHE_DIR = "data/cache/llm"
+MAX_LLM_CACHE_SIZE_MB = 200
+MAX_LLM_CACHE_AGE_DAYS = 30
+RESPONSE_TOKENS = 1500    # Room kept free for the model's JSON answer
+# Characters per token of the model's tokenizer, per transcript format. These are starting values:
+# raw SRT is mostly digits and timestamps, which tokenize densely; the compact format is close to
+# plain English prose. After each run the ratio is measured from Ollama's prompt_eval_count on
+# requests that evaluated their whole prompt and stored per model in TOKEN_CALIBRATION_FILE.
+# The stored ratio decides where chunks are cut, and so the response cache keys: it is rounded
+# down to CALIBRATION_STEP and only replaced when the measurement drifts by CALIBRATION_MIN_DRIFT,
+# so re-runs keep hitting the cache.
+CHARS_PER_TOKEN = {"srt": 3.0, "compact": 4.0}
+TOKEN_CALIBRATION_FILE = "data/cache/llm-calibration.json"
+CALIBRATION_STEP = 0.25
+CALIBRATION_MIN_DRIFT = 0.5
+OVERLAP_SECONDS = 30      # Cues repeated at the start of the next chunk so boundary clips are not lost
+
+# Send the transcript as "[seconds] words" lines instead of raw SRT (far fewer prompt tokens).
+# The times the model returns are mapped back to exact SRT cue timestamps afterwards.
+COMPACT_TRANSCRIPT = True
+COMPACT_FORMAT_NOTE = "A transcript will be provided for you as plain lines of the form [seconds] words, where seconds is when that line starts, counted from the start of the video."
+COMPACT_TIMESTAMP_NOTE = "Again, the timestamp format is whole seconds from the start of the video (e.g., \"652 --> 702\")."
+
+def estimate_tokens(text, chars_per_token=CHARS_PER_TOKEN["srt"]):
+    """Estimate how many tokens the model's tokenizer turns text into."""
+    return math.ceil(len(text) / chars_per_token)
+
+def chars_per_token(transcript_format):
+    """The measured characters per token of MODEL_NAME for a transcript format, or the default."""
+    try:
+        with open(TOKEN_CALIBRATION_FILE, 'r') as f:
+            return json.load(f)[MODEL_NAME][transcript_format]
+    except (OSError, json.JSONDecodeError, KeyError):
+        return CHARS_PER_TOKEN[transcript_format]
+
+def calibrate_chars_per_token(transcript_format, stats, prompt_chars, slots):
+    """Measure characters per token from the requests of a run and store it for the next run.
+
+    Only a request that evaluated its whole prompt tells the real ratio; one that reused the cached
+    system prompt looks like far fewer tokens. The first request on each of the `slots` slots
+    (the server's OLLAMA_NUM_PARALLEL, capped by how many requests were in flight) is trusted when
+    it clearly evaluated more per character than the later ones (the prefix was reused after it),
+    or when it is the only kind of request and the model had just been loaded (all caches empty).
+
+    The stored ratio is rounded down to CALIBRATION_STEP and only changed on a drift of at least
+    CALIBRATION_MIN_DRIFT, so chunk boundaries (and the response cache keys) stay put between runs.
+    """
+    stats = sorted(stats)
+    cold, warm = stats[:slots], stats[slots:]
+    if not cold:
+        return
+    cold_ratio = sum(prompt_chars[s[3]] for s in cold) / sum(s[1] for s in cold)
+    if warm:
+        warm_ratio = sum(prompt_chars[s[3]] for s in warm) / sum(s[1] for s in warm)
+        trusted = cold_ratio < 0.9 * warm_ratio
+    else:
+        trusted = any(s[4] > 0.5 for s in cold)
+    log_info(f"Measured {cold_ratio:.2f} characters per token on {transcript_format} prompts "
+             f"(estimate used {chars_per_token(transcript_format):.2f}){'' if trusted else ', not trusted (prompt may have been cached)'}")
+    if not trusted or not 1.5 <= cold_ratio <= 8:
+        return
+    if abs(cold_ratio - chars_per_token(transcript_format)) < CALIBRATION_MIN_DRIFT:
+        return
+
+    try:
+        with open(TOKEN_CALIBRATION_FILE, 'r') as f:
+            calibration = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        calibration = {}
+    # Rounded down: overestimating the ratio would overfill num_ctx
+    calibration.setdefault(MODEL_NAME, {})[transcript_format] = math.floor(cold_ratio / CALIBRATION_STEP) * CALIBRATION_STEP
+    log_info(f"Stored {calibration[MODEL_NAME][transcript_format]:.2f} characters per token for {transcript_format} prompts")
+    os.makedirs(os.path.dirname(TOKEN_CALIBRATION_FILE), exist_ok=True)
+    with open(TOKEN_CALIBRATION_FILE, 'w') as f:
+        json.dump(calibration, f, indent=4)
+
+def chunk_cues(cues, token_budget, overlap_seconds=OVERLAP_SECONDS, count_tokens=estimate_tokens, formatter=format_cues):
+    """Pack whole SRT cues (formatted with formatter) into chunks of at most token_budget tokens.
+
+    Each chunk after the first starts with the cues from the last overlap_seconds of the
+    previous one. Yields (chunk text, token count) pairs.
+    """
+    start = 0
+    while start < len(cues):
+        tokens = 0
+        end = start
+        while end < len(cues):
+            cue_tokens = count_tokens(formatter([cues[end]])) + 1
+            if tokens + cue_tokens > token_budget and end > start:
+                break
+            tokens += cue_tokens
+            end += 1
+        yield formatter(cues[start:end]), tokens
+
+        if end >= len(cues):
+            break
+        # Step back over the overlap, but always move forward
+        next_start = end
+        while next_start - 1 > start and cues[next_start - 1]['start'] >= cues[end - 1]['end'] - overlap_seconds:
+            next_start -= 1
+        start = next_start
 
 def count_words(text):
     # Split the text by spaces (and newlines, tabs, etc.) and return the length of the list
     words = text.split()
     return len(words)
 
-def decide_clips(srt_file, decision_file):
-    template = """
-    Answer the question below.
+def response_cache_key(template, context, chunk):
+    """Hash of the model, its sampling parameters, the prompt and the chunk."""
+    key = json.dumps({
+        "model": MODEL_NAME,
+        "params": MODEL_PARAMS,
+        "format": CLIP_SCHEMA,
+        "template": template,
+        "context": context,
+        "chunk": chunk,
+    }, sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def load_cached_response(key):
+    """Return the cached {"raw", "segments"} entry for a key, or None."""
+    path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            entry = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    os.utime(path)  # Recently used entries are evicted last
+    return entry
+
+def save_cached_response(key, raw, segments):
+    """Store a raw response and the segments parsed from it."""
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+    with open(path + ".tmp", 'w') as f:
+        json.dump({"model": MODEL_NAME, "raw": raw, "segments": segments}, f)
+    os.replace(path + ".tmp", path)
+
+def clean_llm_cache():
+    """Evict cached responses that are too old, then the least recently used until under the size limit."""
+    if not os.path.isdir(LLM_CACHE_DIR):
+        return
+    cache_files = [os.path.join(LLM_CACHE_DIR, f) for f in os.listdir(LLM_CACHE_DIR) if f.endswith('.json')]
+    total_size = sum(os.path.getsize(f) for f in cache_files) / (1024 * 1024)  # Convert to MB
+    current_time = time.time()
+
+    # Least recently used first
+    cache_files.sort(key=lambda f: os.path.getmtime(f))
 
+    for file in cache_files:
+        file_age_days = (current_time - os.path.getmtime(file)) / (60 * 60 * 24)
+        if total_size > MAX_LLM_CACHE_SIZE_MB or file_age_days > MAX_LLM_CACHE_AGE_DAYS:
+            total_size -= os.path.getsize(file) / (1024 * 1024)
+            os.remove(file)
+
+def restore_timestamps(segments, cues):
+    """Turn the times the model returned (seconds or timestamps) into exact SRT timestamps
+    snapped to cue boundaries."""
+    for segment in segments:
+        try:
+            start, end = snap_to_cues(*parse_timestamp(segment['timestamp']), cues)
+        except (KeyError, ValueError) as e:
+            log_warning(f"Could not map timestamp back for segment {segment.get('title', '')}: {e}")
+            continue
+        segment['timestamp'] = f"{format_timestamp(start)} --> {format_timestamp(end)}"
+    return segments
+
+def valid_clip(clip):
+    """A clip is usable once it has a start --> end timestamp."""
+    return isinstance(clip.get('timestamp'), str) and '-->' in clip['timestamp']
+
+def log_prompt_eval(stats, slots):
+    """Summarize prompt-eval time of the (sent at, tokens, seconds, ...) stats. Ollama keeps a KV cache
+    per parallel slot (OLLAMA_NUM_PARALLEL of them), so the first request on each of the `slots` slots pays for the shared system
+    prompt; later requests should only pay for their transcript if the prefix is reused."""
+    if not stats:
+        return
+    stats = sorted(stats)  # In the order the requests were sent
+    cold, warm = stats[:slots], stats[slots:]
+    for label, group in (("first request per slot", cold), ("later requests", warm)):
+        if group:
+            tokens = sum(s[1] for s in group) / len(group)
+            seconds = sum(s[2] for s in group) / len(group)
+            log_info(f"Prompt eval, {label} (average of {len(group)}): {tokens:.0f} tokens in {seconds:.1f}s")
+
+def evaluate_chunk(chain, context, chunk, index, total, cache_key=None, stats=None):
+    """Run one transcript chunk through the model and return the clips it picked.
+
+    A failed call or an answer that is not a complete JSON array is retried (only this chunk,
+    at most MAX_CHUNK_RETRIES times); if no attempt parses cleanly, the most clips salvaged from
+    any attempt are used. Any failure is logged and only costs this chunk.
+    """
+    if cache_key:
+        cached = load_cached_response(cache_key)
+        if cached is not None:
+            log_attribute(f"Chunk {index}/{total}: using cached response ({len(cached['segments'])} clips)")
+            return cached['segments']
+
+    # Print the current chunk for debugging
+    print({"context": context, "transcript": chunk})
+
+    salvaged = []
+    for attempt in range(1, MAX_CHUNK_RETRIES + 2):
+        try:
+            # Get the result from the model
+            sent_at = time.perf_counter()
+            message = chain.invoke({"context": context, "transcript": chunk})
+        except Exception as e:
+            log_error(f"Chunk {index}/{total}: model call failed (attempt {attempt}): {e}")
+            continue
+        result = message.content
+        log_info(result)
+
+        # Ollama reports how many prompt tokens it actually had to evaluate; with the system
+        # prompt's KV state reused this is roughly just the transcript chunk
+        metadata = message.response_metadata or {}
+        if 'prompt_eval_count' in metadata:
+            prompt_eval_seconds = metadata.get('prompt_eval_duration', 0) / 1e9
+            log_attribute(f"Chunk {index}/{total}: prompt eval {metadata['prompt_eval_count']} tokens in {prompt_eval_seconds:.1f}s")
+            if stats is not None:
+                stats.append((sent_at, metadata['prompt_eval_count'], prompt_eval_seconds, index, metadata.get('load_duration', 0) / 1e9))
+
+        clips, complete = parse_object_list(result)
+        clips = [clip for clip in clips if valid_clip(clip)]
+        if complete:
+            log_attribute(f"Chunk {index}/{total}: {len(clips)} clips")
+            if cache_key:
+                save_cached_response(cache_key, result, clips)
+            return clips
+
+        log_warning(f"Chunk {index}/{total}: answer is not a complete JSON array (attempt {attempt}), salvaged {len(clips)} clips")
+        if len(clips) > len(salvaged):
+            salvaged = clips
+
+    # Out of retries: use what could be salvaged, but do not cache it so a re-run tries again
+    if salvaged:
+        log_warning(f"Chunk {index}/{total}: using {len(salvaged)} salvaged clips")
+    else:
+        log_error(f"Chunk {index}/{total}: no usable answer after {MAX_CHUNK_RETRIES + 1} attempts")
+    return salvaged
+
+def decide_clips(srt_file, decision_file, max_in_flight=MAX_IN_FLIGHT, count_tokens=None, compact=COMPACT_TRANSCRIPT, candidate_windows=None):
+    # The instructions go in a system message that is identical for every chunk, so the server
+    # can keep its evaluated prefix; only the human message changes per chunk
+    system_template = """
     Here is the context: {context}
+    """
+
+    template = """
+    Answer the question below.
 
     Transcript:
     {transcript}
@@ -110,46 +401,59 @@ def decide_clips(srt_file, decision_file):
     length = len(f) + len(context) + 40
     print(length)
 
-    # model = OllamaLLM(model="gemma2:27b", verbose=True)
-    model = OllamaLLM(
-        model="gemma2:27b",
-        temperature=0.6,          # Lower temperature for more deterministic responses
-        top_k=30,                 # Narrow down the token selection to reduce randomness
-        top_p=0.85,               # Adjust nucleus sampling for more focused results
-        repeat_penalty=1.1,       # Penalize token repetition to avoid loops
-        mirostat=2,               # Enable Mirostat for dynamic perplexity control
-        mirostat_eta=0.1,         # Set the learning rate for Mirostat
-        mirostat_tau=5.0,         # Target perplexity for Mirostat to control randomness
-        num_ctx=8196,             # Maximum context tokens for better understanding of inputs
-        # stop=["\n", "End"]        # Stop tokens to prevent over-generation and hallucinations
-        verbose=True
-    )
-    prompt = ChatPromptTemplate.from_template(template)
+    started = time.perf_counter()
+    cues = parse_srt(f)
+    if candidate_windows is not None:
+        # Only the pre-ranked windows (see candidate_ranker) are sent to the model
+        cues = [cue for cue in cues if any(cue['start'] < end and cue['end'] > start for start, end in candidate_windows)]
+    if compact:
+        context = context.replace("A transcript will be provided for you in SRT format.", COMPACT_FORMAT_NOTE)
+        context = context.replace("Again, the timestamp format is hh:mm:ss,ms (e.g., [00:00:09,400]).", COMPACT_TIMESTAMP_NOTE)
+        units, formatter = merge_utterances(cues), format_compact
+    else:
+        units, formatter = cues, format_cues
+    transcript_format = "compact" if compact else "srt"
+    if count_tokens is None:
+        ratio = chars_per_token(transcript_format)
+        count_tokens = lambda text: estimate_tokens(text, ratio)
+
+    model = ChatOllama(model=MODEL_NAME, **MODEL_PARAMS, keep_alive=KEEP_ALIVE, format=CLIP_SCHEMA, verbose=True)
+    prompt = ChatPromptTemplate.from_messages([("system", system_template), ("human", template)])
     chain = prompt | model
 
 
     all_results = []
 
     
-    chunk_size = 1000  # Adjust as needed based on token limit
-    for chunk in chunk_transcript(f, chunk_size):
-        # Print the current chunk for debugging
-        print({"context": context, "transcript": chunk})
+    # Whatever the prompt itself does not use of the context window (minus room for the answer)
+    # is the budget for transcript cues
+    prompt_tokens = count_tokens(system_template.format(context=context) + template.format(transcript=""))
+    token_budget = NUM_CTX - prompt_tokens - RESPONSE_TOKENS
+    chunks = []
+    for chunk, chunk_tokens in chunk_cues(units, token_budget, count_tokens=count_tokens, formatter=formatter):
+        total_tokens = prompt_tokens + chunk_tokens
+        log_attribute(f"Chunk {len(chunks) + 1}: {chunk_tokens} transcript + {prompt_tokens} prompt tokens = "
+                      f"{total_tokens}/{NUM_CTX} ({total_tokens / NUM_CTX:.0%} of num_ctx, "
+                      f"{chunk_tokens / token_budget:.0%} of the transcript budget)")
+        chunks.append(chunk)
+    log_info(f"Evaluating {len(chunks)} chunks, up to {max_in_flight} at a time")
 
-        # Get the result from the model
-        result = chain.invoke({"context": context, "transcript": chunk})
-        log_info(result)
-        
-        # Parse the result as JSON (assuming the result is a valid JSON array)
-        try:
-            json_result = json.loads(result)
-            if isinstance(json_result, list):
-                # Append the parsed JSON result to the all_results list
-                all_results.extend(json_result)
-            else:
-                log_warning("Expected a list, but got something else.")
-        except json.JSONDecodeError as e:
-            log_error(f"Failed to parse JSON: {e}")
+    # The chunks run concurrently, but their clips are merged back in transcript order
+    prompt_eval_stats = []
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as pool:
+        futures = [
+            pool.submit(evaluate_chunk, chain, context, chunk, i, len(chunks), response_cache_key(system_template + template, context, chunk), prompt_eval_stats)
+            for i, chunk in enumerate(chunks, start=1)
+        ]
+        for future in futures:
+            # Append the parsed JSON result to the all_results list
+            all_results.extend(future.result())
+    # Requests beyond the server's slots queue and land on a slot that is already warm
+    slots = min(max(1, max_in_flight), SERVER_SLOTS, len(chunks))
+    log_prompt_eval(prompt_eval_stats, slots)
+    # Index 0 is unused: chunks are numbered from 1
+    prompt_chars = [0] + [len(system_template.format(context=context)) + len(template.format(transcript=chunk)) for chunk in chunks]
+    calibrate_chars_per_token(transcript_format, prompt_eval_stats, prompt_chars, slots)
 
 
     # result = chain.invoke({
@@ -159,10 +463,16 @@ def decide_clips(srt_file, decision_file):
 
     # log_info(result)
 
+    if compact:
+        restore_timestamps(all_results, cues)
+
     # Write the combined JSON array to the decision file
     with open(decision_file, 'w') as tf:
         json.dump(all_results, tf, indent=4)  # Pretty-print the JSON if needed
 
+    log_info(f"Decided on {len(all_results)} clips from {len(chunks)} chunks in {time.perf_counter() - started:.1f}s")
+    clean_llm_cache()
+
 
 if __name__ == "__main__":
     decide_clips(srt_file="data/temp/[BBP]-[EOW]-RAW__10-04-24__[20]-2-audio.srt", decision_file="out.txt")
\ No newline at end of file
@@ -0,0 +1,47 @@
+import re
+import json
+
+# The model is asked for a JSON array of clip objects, but answers can still come back
+# wrapped in ```json fences, with chatter around them, or cut off halfway through.
+# These helpers keep every object that did come through intact.
+
+_decoder = json.JSONDecoder()
+
+def strip_fences(text):
+    """Remove Markdown code fences the model sometimes wraps its answer in."""
+    return re.sub(r"```(?:json)?", "", text).strip()
+
+def salvage_objects(text):
+    """Scan text left to right and return every top-level JSON object that decodes on its own.
+    A truncated trailing object (or any broken one) is skipped."""
+    objects = []
+    pos = 0
+    while True:
+        pos = text.find('{', pos)
+        if pos == -1:
+            break
+        try:
+            obj, end = _decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            pos += 1
+            continue
+        if isinstance(obj, dict):
+            objects.append(obj)
+        pos = end
+    return objects
+
+def parse_object_list(text):
+    """Parse a JSON array of objects. Returns (objects, complete): complete is True when the
+    whole answer was a valid array, False when the objects had to be salvaged."""
+    text = strip_fences(text)
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return salvage_objects(text), False
+    if isinstance(data, dict):
+        # A single object, or the array wrapped in an object ({"clips": [...]})
+        lists = [value for value in data.values() if isinstance(value, list)]
+        data = lists[0] if len(lists) == 1 else [data]
+    if not isinstance(data, list):
+        return [], False
+    return [obj for obj in data if isinstance(obj, dict)], True
@@ -0,0 +1,137 @@
+import re
+
+try:
+    from utils.log_manager import log_info, log_attribute, log_warning, log_error
+except ImportError:
+    from log_manager import log_info, log_attribute, log_warning, log_error
+
+COPY_SLACK_SECONDS = 0.01  # A repeated line starting this close to the previous cue's end is a writer copy
+
+TIMESTAMP_LINE = re.compile(r"(\d+:\d{2}:\d{2}[,.]\d{1,3})\s*-->\s*(\d+:\d{2}:\d{2}[,.]\d{1,3})")
+
+def time_to_seconds(time_str):
+    """Convert time string to seconds, handling dot, comma, and frame-based timestamps, and bare
+    (whole or fractional) seconds such as the compact transcript uses ("652")."""
+    time_str = str(time_str).strip().strip('[]').strip()
+    if re.fullmatch(r"\d+(\.\d+)?", time_str):
+        return float(time_str)
+
+    # Check if the timestamp contains a frame count (format: HH:MM:SS:FF)
+    frame_pattern = r"(\d{2}):(\d{2}):(\d{2}):(\d{2})"
+    match_frame = re.match(frame_pattern, time_str)
+    if match_frame:
+        h, m, s, frames = map(int, match_frame.groups())
+        # Assuming 30 frames per second (you can adjust this depending on your use case)
+        frames_to_seconds = frames / 30.0
+        return h * 3600 + m * 60 + s + frames_to_seconds
+
+    # Handle the case for milliseconds with a dot or comma separator (HH:MM:SS.mmm or HH:MM:SS,mmm)
+    time_str = time_str.replace(',', '.')  # Normalize comma to dot for float compatibility
+    parts = time_str.split(':')
+    
+    if len(parts) == 3:
+        h, m, s = parts[0], parts[1], parts[2]
+    elif len(parts) == 2:
+        h = '0'  # Handle case where hours are omitted (MM:SS.mmm)
+        m, s = parts[0], parts[1]
+    else:
+        raise ValueError(f"Invalid time format: {time_str}")
+
+    # Handle seconds and milliseconds
+    s_parts = s.split('.')
+    seconds = int(s_parts[0])
+    milliseconds = float(f"0.{s_parts[1]}") if len(s_parts) == 2 else 0
+
+    return int(h) * 3600 + int(m) * 60 + seconds + milliseconds
+
+def parse_timestamp(timestamp):
+    """(start, end) seconds of a "start --> end" timestamp, in any format time_to_seconds reads."""
+    start_str, end_str = str(timestamp).strip().strip('[]').split('-->')
+    return time_to_seconds(start_str), time_to_seconds(end_str)
+
+def format_timestamp(seconds):
+    """Format seconds as an SRT timestamp (hh:mm:ss,mmm)."""
+    milliseconds = int(round(seconds * 1000))
+    h, milliseconds = divmod(milliseconds, 3600000)
+    m, milliseconds = divmod(milliseconds, 60000)
+    s, milliseconds = divmod(milliseconds, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d},{milliseconds:03d}"
+
+def parse_srt(text):
+    """Parse SRT text into a list of cues: {"index", "start", "end", "text"} with times in seconds."""
+    cues = []
+    for block in re.split(r"\n\s*\n", text.strip()):
+        lines = [line.strip() for line in block.strip().splitlines()]
+        for n, line in enumerate(lines):
+            match = TIMESTAMP_LINE.search(line)
+            if not match:
+                continue
+            index = lines[n - 1] if n > 0 and lines[n - 1].isdigit() else str(len(cues) + 1)
+            cues.append({
+                "index": int(index),
+                "start": time_to_seconds(match.group(1)),
+                "end": time_to_seconds(match.group(2)),
+                "text": ' '.join(lines[n + 1:]),
+            })
+            break
+    return cues
+
+def read_srt(srt_file):
+    """Read and parse an SRT file."""
+    with open(srt_file, "r") as file:
+        return parse_srt(file.read())
+
+def format_cue(cue):
+    """Format one cue back into an SRT block."""
+    return f"{cue['index']}\n{format_timestamp(cue['start'])} --> {format_timestamp(cue['end'])}\n{cue['text']}\n"
+
+def format_cues(cues):
+    """Format cues back into SRT text."""
+    return '\n'.join(format_cue(cue) for cue in cues)
+
+def merge_utterances(cues, max_gap=1.0, max_seconds=20):
+    """Merge consecutive cues into utterances (pauses shorter than max_gap, at most max_seconds long).
+    Highlight markup is stripped, and the repeats the highlighted writer produces (the same line
+    again, highlighted or starting where the previous cue ends) are dropped. A line that is genuinely
+    said twice ("no no", "let's go") is kept."""
+    utterances = []
+    previous_text, previous_end = None, None
+    for cue in cues:
+        text = re.sub(r"<[^>]+>", "", cue['text']).strip()
+        highlighted = text != cue['text'].strip()
+        # The highlighted writer also fills each gap between words with an unmarked copy that
+        # starts right where the previous cue ended
+        repeat = text == previous_text and (highlighted or cue['start'] <= previous_end + COPY_SLACK_SECONDS)
+        previous_text, previous_end = text, cue['end']
+        if repeat and utterances:
+            # Same words again: the utterance just lasts as long as its last highlighted copy
+            utterances[-1]['end'] = max(utterances[-1]['end'], cue['end'])
+        if not text or repeat:
+            continue
+
+        last = utterances[-1] if utterances else None
+        if last and cue['start'] - last['end'] < max_gap and cue['end'] - last['start'] <= max_seconds:
+            last['end'] = cue['end']
+            last['text'] += ' ' + text
+        else:
+            utterances.append({"index": len(utterances) + 1, "start": cue['start'], "end": cue['end'], "text": text})
+    return utterances
+
+def format_compact(utterances):
+    """One line per utterance, prefixed with its start as whole seconds: "[652] words..."."""
+    return '\n'.join(f"[{int(u['start'])}] {u['text']}" for u in utterances)
+
+def snap_to_cues(start, end, cues):
+    """Snap start to the start of the cue it falls in and end to the end of the cue it falls in,
+    so a clip never starts or stops mid-cue. A second of slack covers whole-second times."""
+    for cue in cues:
+        if cue['end'] > start:
+            if cue['start'] <= start + 1:
+                start = cue['start']
+            break
+    for cue in reversed(cues):
+        if cue['start'] < end:
+            if cue['end'] >= end - 1:
+                end = cue['end']
+            break
+    return start, end
@@ -0,0 +1,331 @@
+import os
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from utils.log_manager import log_info, log_attribute, log_warning, log_error
+from utils.whisper_utils import get_model, transcribe, DEFAULT_MODEL, DEFAULT_BACKEND
+from utils.vad import frame_energy, FRAME_SECONDS
+from utils.audio_utils import pcm_stream, load_pcm, SAMPLE_RATE
+
+WINDOW_SECONDS = 600         # Target length of each window handed to a worker
+SEARCH_SECONDS = 15          # How far around the target cut point to look for silence
+STREAM_WINDOW_SECONDS = 120  # Audio decoded and transcribed at a time in streaming mode
+PROMPT_WORDS = 60            # Words of the previous window carried over as decoder context
+
+# Set in each worker process by _init_worker
+_worker_model = None
+
+# A window is the audio handed to one transcribe call plus a time map.
+# The time map is a list of (window time, original time, duration) pieces in seconds,
+# so windows built from several speech regions can still be mapped back to the full file.
+
+def split_at_silence(audio, window_seconds=WINDOW_SECONDS, search_seconds=SEARCH_SECONDS):
+    """Split a waveform into (start, end) sample ranges of roughly window_seconds,
+    cutting at the quietest frame near each target boundary so words are not split."""
+    total = len(audio)
+    window = int(window_seconds * SAMPLE_RATE)
+    if total <= window:
+        return [(0, total)]
+
+    energy = frame_energy(audio)
+    frame = int(SAMPLE_RATE * FRAME_SECONDS)
+    search = int(search_seconds / FRAME_SECONDS)
+
+    windows = []
+    start = 0
+    while total - start > window:
+        target = (start + window) // frame
+        lo = max(target - search, start // frame + 1)
+        hi = min(target + search, len(energy))
+        cut = (lo + int(np.argmin(energy[lo:hi]))) * frame if hi > lo else target * frame
+        windows.append((start, cut))
+        start = cut
+    windows.append((start, total))
+    return windows
+
+def silence_windows(audio, window_seconds=WINDOW_SECONDS):
+    """Build windows covering the whole waveform, split at silences."""
+    windows = []
+    for start, end in split_at_silence(audio, window_seconds):
+        time_map = [(0.0, start / SAMPLE_RATE, (end - start) / SAMPLE_RATE)]
+        windows.append((audio[start:end], time_map))
+    return windows
+
+def speech_windows(audio, regions, window_seconds=WINDOW_SECONDS):
+    """Build windows that contain only the given speech regions, packed back to back
+    up to window_seconds each. Regions longer than a window (long stretches of talk, or music
+    the VAD keeps) are first cut at silences, each piece keeping its own time map entry."""
+    pieces_of_regions = []
+    for start, end in regions:
+        if end - start <= window_seconds:
+            pieces_of_regions.append((start, end))
+            continue
+        region = audio[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)]
+        for piece_start, piece_end in split_at_silence(region, window_seconds):
+            pieces_of_regions.append((start + piece_start / SAMPLE_RATE, start + piece_end / SAMPLE_RATE))
+
+    windows = []
+    pieces, time_map, length = [], [], 0.0
+    for start, end in pieces_of_regions:
+        if pieces and length + (end - start) > window_seconds:
+            windows.append((np.concatenate(pieces), time_map))
+            pieces, time_map, length = [], [], 0.0
+        pieces.append(audio[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)])
+        time_map.append((length, start, end - start))
+        length += len(pieces[-1]) / SAMPLE_RATE
+    if pieces:
+        windows.append((np.concatenate(pieces), time_map))
+    return windows
+
+def map_time(t, time_map):
+    """Map a time inside a window back onto the original timeline."""
+    for window_start, original_start, duration in reversed(time_map):
+        if t >= window_start:
+            return round(original_start + min(t - window_start, duration), 3)
+    return round(time_map[0][1], 3)
+
+def remap_result(result, time_map):
+    """Move every segment and word timestamp in a window result onto the original timeline."""
+    for segment in result['segments']:
+        segment['start'] = map_time(segment['start'], time_map)
+        segment['end'] = map_time(segment['end'], time_map)
+        for word in segment.get('words', []):
+            word['start'] = map_time(word['start'], time_map)
+            word['end'] = map_time(word['end'], time_map)
+    return result
+
+def stitch_results(results):
+    """Join per-window results (already on the global timeline) into one result dict
+    with the same shape model.transcribe returns."""
+    segments = []
+    for result in results:
+        for segment in result['segments']:
+            segment['id'] = len(segments)
+            segments.append(segment)
+    return {
+        'text': ''.join(result['text'] for result in results),
+        'segments': segments,
+        'language': results[0].get('language', 'en') if results else 'en',
+    }
+
+def _init_worker(model_name, backend, threads_per_worker, batch_size):
+    """Load the model once per worker process and pin its thread count."""
+    global _worker_model
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_worker)  # CTranslate2 backends read this
+    try:
+        import torch
+        torch.set_num_threads(threads_per_worker)
+    except ImportError:
+        pass
+    _worker_model = (model_name, backend, batch_size)
+    get_model(model_name, backend=backend)
+
+def _transcribe_window(audio, time_map, model_name=None, backend=None, batch_size=1, initial_prompt=None):
+    if model_name is None:
+        model_name, backend, batch_size = _worker_model
+    result = transcribe(audio, model_name, backend, batch_size=batch_size, initial_prompt=initial_prompt)
+    return remap_result(result, time_map)
+
+def window_key(time_map):
+    """Identify a window by the span of the original timeline it covers."""
+    start = time_map[0][1]
+    end = time_map[-1][1] + time_map[-1][2]
+    return f"{start:.3f}-{end:.3f}"
+
+def load_checkpoints(checkpoint_file, model_name, backend):
+    """Read finished windows from a checkpoint file. Returns {window key: result}."""
+    done = {}
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return done
+    with open(checkpoint_file, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be half written if the run was killed mid-write
+                log_warning(f"Ignoring damaged checkpoint line in {checkpoint_file}")
+                continue
+            if entry.get('model') == model_name and entry.get('backend') == backend:
+                done[entry['window']] = entry['result']
+    return done
+
+def save_checkpoint(checkpoint_file, key, result, model_name, backend):
+    """Append one finished window to the checkpoint file and make sure it reaches disk."""
+    with open(checkpoint_file, 'a') as f:
+        f.write(json.dumps({'window': key, 'model': model_name, 'backend': backend, 'result': result}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def run_windows(windows, model_name=DEFAULT_MODEL, workers=1, threads_per_worker=None, backend=DEFAULT_BACKEND, checkpoint_file=None, batch_size=1):
+    """Transcribe a list of (audio, time map) windows. Returns one result per window, in order.
+
+    With more than one worker the windows run in a process pool. Every worker holds its
+    own copy of the model, so memory grows with the number of workers.
+
+    If checkpoint_file is given, every finished window is appended to it and windows that
+    are already in it are not transcribed again, so an interrupted run picks up where it stopped.
+    """
+    keys = [window_key(time_map) for _, time_map in windows]
+    results = load_checkpoints(checkpoint_file, model_name, backend)
+    pending = [i for i, key in enumerate(keys) if key not in results]
+    if len(pending) < len(windows):
+        log_info(f"Resuming transcription: {len(windows) - len(pending)}/{len(windows)} windows already checkpointed")
+
+    def finish(i, result):
+        results[keys[i]] = result
+        if checkpoint_file:
+            save_checkpoint(checkpoint_file, keys[i], result, model_name, backend)
+        log_attribute(f"Window {i + 1}/{len(windows)} transcribed")
+
+    if workers <= 1 or len(pending) <= 1:
+        for i in pending:
+            audio, time_map = windows[i]
+            finish(i, _transcribe_window(audio, time_map, model_name, backend, batch_size))
+    else:
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        log_info(f"Transcribing {len(pending)} windows with {workers} workers x {threads_per_worker} threads")
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model_name, backend, threads_per_worker, batch_size)) as pool:
+            futures = {pool.submit(_transcribe_window, *windows[i]): i for i in pending}
+            for future in as_completed(futures):
+                finish(futures[future], future.result())
+
+    return [results[key] for key in keys]
+
+def transcribe_windows(windows, model_name=DEFAULT_MODEL, workers=1, threads_per_worker=None, backend=DEFAULT_BACKEND, checkpoint_file=None):
+    """Transcribe a list of (audio, time map) windows and stitch them into one result."""
+    return stitch_results(run_windows(windows, model_name, workers, threads_per_worker, backend, checkpoint_file))
+
+def transcribe_parallel(audio_file, model_name=DEFAULT_MODEL, workers=2, threads_per_worker=None, speech_regions=None, backend=DEFAULT_BACKEND, checkpoint_file=None):
+    """Transcribe an audio file window by window.
+
+    If speech_regions is given only those regions are sent to the model; otherwise the
+    whole file is split at silences.
+    """
+    windows = file_windows(audio_file, speech_regions)
+    return transcribe_windows(windows, model_name, workers, threads_per_worker, backend, checkpoint_file)
+
+def file_windows(audio_file, speech_regions=None):
+    """Load an audio file and cut it into windows (speech regions only, if given)."""
+    audio = load_pcm(audio_file)
+    if speech_regions is not None:
+        windows = speech_windows(audio, speech_regions)
+    else:
+        windows = silence_windows(audio)
+    log_info(f"{audio_file}: {len(audio) / SAMPLE_RATE:.0f}s of audio in {len(windows)} windows")
+    return windows
+
+def transcribe_batch(audio_files, model_name=DEFAULT_MODEL, workers=1, threads_per_worker=None, speech_regions_list=None, backend=DEFAULT_BACKEND, batch_size=8, checkpoint_files=None, on_file_done=None):
+    """Transcribe many audio files in one go. Returns one result per file, in order.
+
+    All files go through the same model instance (or worker pool), so short inputs do not
+    each pay the setup cost. A file is only loaded when its turn comes; its windows are queued
+    while the previous file's last windows are still running, so the workers stay busy across
+    file boundaries with at most two files in memory. Backends that support it decode
+    batch_size chunks of each window at once.
+
+    Each file can have its own checkpoint file (see run_windows), and on_file_done(index, result)
+    is called as soon as a file is finished, so a crash only loses the files still in flight.
+    """
+    speech_regions_list = speech_regions_list or [None] * len(audio_files)
+    checkpoint_files = checkpoint_files or [None] * len(audio_files)
+    log_info(f"Batch transcribing {len(audio_files)} files")
+
+    pool = None
+    if workers > 1:
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        log_info(f"Using {workers} workers x {threads_per_worker} threads")
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model_name, backend, threads_per_worker, batch_size))
+
+    outputs = [None] * len(audio_files)
+
+    def start(n):
+        windows = file_windows(audio_files[n], speech_regions_list[n])
+        keys = [window_key(time_map) for _, time_map in windows]
+        results = load_checkpoints(checkpoint_files[n], model_name, backend)
+        pending = [i for i, key in enumerate(keys) if key not in results]
+        if len(pending) < len(windows):
+            log_info(f"{audio_files[n]}: {len(windows) - len(pending)}/{len(windows)} windows already checkpointed")
+        if pool is None:
+            futures = {}
+            for i in pending:
+                finish_window(n, keys[i], results, _transcribe_window(*windows[i], model_name, backend, batch_size))
+        else:
+            futures = {pool.submit(_transcribe_window, *windows[i]): i for i in pending}
+        return n, keys, results, futures
+
+    def finish_window(n, key, results, result):
+        results[key] = result
+        if checkpoint_files[n]:
+            save_checkpoint(checkpoint_files[n], key, result, model_name, backend)
+
+    def finish(job):
+        n, keys, results, futures = job
+        for future in as_completed(futures):
+            finish_window(n, keys[futures[future]], results, future.result())
+        outputs[n] = stitch_results([results[key] for key in keys])
+        log_attribute(f"File {n + 1}/{len(audio_files)} transcribed: {audio_files[n]}")
+        if on_file_done:
+            on_file_done(n, outputs[n])
+
+    try:
+        in_flight = deque()
+        for n in range(len(audio_files)):
+            in_flight.append(start(n))
+            # Without a pool the windows already ran in start(), so there is nothing to overlap
+            while len(in_flight) > (1 if pool is not None else 0):
+                finish(in_flight.popleft())
+        while in_flight:
+            finish(in_flight.popleft())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return outputs
+
+def transcribe_stream(audio_file, model_name=DEFAULT_MODEL, backend=DEFAULT_BACKEND, window_seconds=STREAM_WINDOW_SECONDS):
+    """Transcribe an audio file window by window from an ffmpeg PCM pipe.
+
+    Only about two windows of audio are held in memory at a time, so peak memory does not
+    grow with the length of the file. Each window is cut at the quietest point near its end
+    (the rest is carried into the next window), and the last words of the previous window
+    are passed as the initial prompt so the decoder keeps its context across windows.
+    """
+    window = int(window_seconds * SAMPLE_RATE)
+    search = int(min(SEARCH_SECONDS, window_seconds / 4) * SAMPLE_RATE)
+    frame = int(SAMPLE_RATE * FRAME_SECONDS)
+
+    results = []
+    buffer = np.zeros(0, dtype=np.float32)
+    offset = 0.0
+    prompt = None
+
+    def run(audio):
+        nonlocal offset, prompt
+        result = _transcribe_window(audio, [(0.0, offset, len(audio) / SAMPLE_RATE)], model_name, backend, initial_prompt=prompt)
+        results.append(result)
+        words = ''.join(segment['text'] for segment in result['segments']).split()
+        prompt = ' '.join(words[-PROMPT_WORDS:]) or prompt
+        offset += len(audio) / SAMPLE_RATE
+        log_attribute(f"Streamed transcription up to {offset:.0f}s")
+
+    for chunk in pcm_stream(audio_file, window_seconds):
+        buffer = np.concatenate([buffer, chunk])
+        if len(buffer) < window:
+            continue
+
+        # Cut at the quietest frame in the last few seconds of the window
+        energy = frame_energy(buffer[window - search:window])
+        cut = window - search + int(np.argmin(energy)) * frame if len(energy) else window
+        run(buffer[:cut])
+        buffer = buffer[cut:]
+
+    if len(buffer):
+        run(buffer)
+
+    return stitch_results(results)
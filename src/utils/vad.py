@@ -0,0 +1,118 @@
+import json
+
+import numpy as np
+
+try:
+    from utils.log_manager import log_info, log_attribute, log_warning, log_error
+    from utils.audio_utils import SAMPLE_RATE
+except ImportError:
+    from log_manager import log_info, log_attribute, log_warning, log_error
+    from audio_utils import SAMPLE_RATE
+
+FRAME_SECONDS = 0.02         # Analysis frame size
+ENERGY_MARGIN_DB = 12        # How far above the noise floor a frame must be to count as speech
+SPEECH_BAND = (300, 3400)    # Where most speech energy lives, in Hz
+MIN_BAND_RATIO = 0.45        # Share of frame energy that must fall inside SPEECH_BAND
+MIN_SPEECH_SECONDS = 0.3     # Shorter bursts are treated as noise
+MIN_SILENCE_SECONDS = 2.0    # Shorter pauses are kept inside the surrounding speech region
+PAD_SECONDS = 0.4            # Padding added around each region so word edges are not clipped
+
+def frame_energy(audio, frame_seconds=FRAME_SECONDS):
+    """Return the RMS energy of consecutive frames of a 16 kHz waveform."""
+    frame = int(SAMPLE_RATE * frame_seconds)
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = audio[:n_frames * frame].reshape(n_frames, frame)
+    return np.sqrt(np.mean(frames ** 2, axis=1))
+
+def band_ratio(audio, frame_seconds=FRAME_SECONDS):
+    """Return, per frame, the share of spectral energy that falls inside SPEECH_BAND."""
+    frame = int(SAMPLE_RATE * frame_seconds)
+    n_frames = len(audio) // frame
+    ratios = np.zeros(n_frames, dtype=np.float32)
+    freqs = np.fft.rfftfreq(frame, 1 / SAMPLE_RATE)
+    in_band = (freqs >= SPEECH_BAND[0]) & (freqs <= SPEECH_BAND[1])
+    window = np.hanning(frame).astype(np.float32)
+
+    # Work in blocks so the spectrum of a multi-hour file is never held in memory at once
+    block = 10000
+    for i in range(0, n_frames, block):
+        frames = audio[i * frame:min(i + block, n_frames) * frame].reshape(-1, frame)
+        power = np.abs(np.fft.rfft(frames * window, axis=1)) ** 2
+        total = power.sum(axis=1) + 1e-10
+        ratios[i:i + len(frames)] = power[:, in_band].sum(axis=1) / total
+    return ratios
+
+def speech_mask(audio):
+    """Return a per-frame boolean mask of frames that look like speech."""
+    energy_db = 20 * np.log10(frame_energy(audio) + 1e-10)
+    if len(energy_db) == 0:
+        return np.zeros(0, dtype=bool)
+
+    # The quietest tenth of the file is taken as the noise floor
+    noise_floor = np.percentile(energy_db, 10)
+    return (energy_db > noise_floor + ENERGY_MARGIN_DB) & (band_ratio(audio) > MIN_BAND_RATIO)
+
+def detect_speech(audio):
+    """Return a list of [start, end] speech regions (in seconds) found in a 16 kHz waveform."""
+    speech = speech_mask(audio)
+
+    # Turn the frame mask into regions
+    regions = []
+    start = None
+    for i, is_speech in enumerate(speech):
+        if is_speech and start is None:
+            start = i
+        elif not is_speech and start is not None:
+            regions.append([start * FRAME_SECONDS, i * FRAME_SECONDS])
+            start = None
+    if start is not None:
+        regions.append([start * FRAME_SECONDS, len(speech) * FRAME_SECONDS])
+
+    # Close short pauses, then drop short bursts and pad what is left
+    merged = []
+    for region in regions:
+        if merged and region[0] - merged[-1][1] < MIN_SILENCE_SECONDS:
+            merged[-1][1] = region[1]
+        else:
+            merged.append(region)
+
+    duration = len(audio) / SAMPLE_RATE
+    padded = []
+    for start, end in merged:
+        if end - start < MIN_SPEECH_SECONDS:
+            continue
+        start, end = max(0.0, start - PAD_SECONDS), min(duration, end + PAD_SECONDS)
+        if padded and start <= padded[-1][1]:
+            padded[-1][1] = end
+        else:
+            padded.append([round(start, 3), round(end, 3)])
+    return padded
+
+def detect_speech_file(audio_file):
+    """Run detect_speech on an audio file. Returns (regions, duration in seconds)."""
+    try:
+        from utils.audio_utils import load_pcm
+    except ImportError:
+        from audio_utils import load_pcm
+    audio = load_pcm(audio_file)
+    return detect_speech(audio), len(audio) / SAMPLE_RATE
+
+def report_skipped(regions, duration):
+    """Log how much of the audio the speech regions let the ASR skip."""
+    speech = sum(end - start for start, end in regions)
+    skipped = max(0.0, duration - speech)
+    percent = 100 * skipped / duration if duration else 0
+    log_info(f"VAD: {len(regions)} speech regions, skipping {skipped:.0f}s of {duration:.0f}s of audio ({percent:.1f}%)")
+
+def save_vad_map(regions, duration, vad_file):
+    """Save speech regions so the VAD pass does not have to run again."""
+    with open(vad_file, 'w') as f:
+        json.dump({"duration": duration, "regions": regions}, f)
+
+def load_vad_map(vad_file):
+    """Load speech regions saved by save_vad_map. Returns (regions, duration)."""
+    with open(vad_file, 'r') as f:
+        data = json.load(f)
+    return data["regions"], data["duration"]
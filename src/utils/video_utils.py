@@ -1,32 +1,128 @@
 import os
 import subprocess
-from moviepy.editor import VideoFileClip
 import re
 import json
+import bisect
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 
 try:
     from utils.log_manager import log_info, log_attribute, log_warning, log_error
+    from utils.audio_utils import load_pcm
+    from utils.vad import speech_mask
+    from utils.json_salvage import salvage_objects
+    from utils.srt_utils import time_to_seconds, parse_timestamp
 except ImportError:
     from log_manager import log_info, log_attribute, log_warning, log_error
+    from audio_utils import load_pcm
+    from vad import speech_mask
+    from json_salvage import salvage_objects
+    from srt_utils import time_to_seconds, parse_timestamp
 
 def extract_audio(video_path, audio_path):
+    # Slow path kept for reference; the pipeline uses audio_utils.extract_pcm instead
+    from moviepy.editor import VideoFileClip
     video = VideoFileClip(video_path)
     audio = video.audio
     audio.write_audiofile(audio_path)
     video.close()
 
-def count_audio_streams(input_file):
-    cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', input_file]
+def get_audio_streams(input_file):
+    cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', input_file]
     result = subprocess.run(cmd, capture_output=True, text=True)
     log_info(result)
     
     # Parse the JSON output
     data = json.loads(result.stdout)
     
-    # Count audio streams
+    # Keep the audio streams, in the order ffmpeg numbers them for -map 0:a:N
     audio_streams = [stream for stream in data['streams'] if stream['codec_type'] == 'audio']
-    return len(audio_streams)
+    for stream in audio_streams:
+        stream['duration'] = float(stream.get('duration') or data['format'].get('duration') or 0)
+    return audio_streams
+
+def count_audio_streams(input_file):
+    return len(get_audio_streams(input_file))
+
+def select_speech_track(input_file, samples=3, sample_seconds=60):
+    """Pick the audio track that carries the most speech (usually the mic track).
+
+    A few short windows spread over the recording are decoded from every track and scored by
+    the share of frames the VAD marks as speech. Tracks titled like a mic get a small head start.
+    """
+    streams = get_audio_streams(input_file)
+    if len(streams) <= 1:
+        return 0
+
+    duration = streams[0]['duration']
+    starts = [max(0.0, duration * (k + 1) / (samples + 1) - sample_seconds / 2) for k in range(samples)]
+
+    best_track, best_score = 0, -1.0
+    for track, stream in enumerate(streams):
+        audio = np.concatenate([load_pcm(input_file, start, sample_seconds, track) for start in starts])
+        mask = speech_mask(audio)
+        score = float(mask.mean()) if len(mask) else 0.0
+
+        title = stream.get('tags', {}).get('title', '').lower()
+        if any(hint in title for hint in ('mic', 'voice', 'speech')):
+            score += 0.05
+
+        log_attribute(f"Audio track {track} ({title or 'untitled'}): speech score {score:.2f}")
+        if score > best_score:
+            best_track, best_score = track, score
+
+    log_info(f"Using audio track {best_track} for transcription")
+    return best_track
+
+def resolve_transcribe_track(input_file, track):
+    """Turn the TRANSCRIBE_TRACK setting ("auto" or a track index) into a track index."""
+    if track == "auto":
+        return select_speech_track(input_file)
+    return int(track)
+
+class AudioPlan:
+    """The final stereo mix of a clip, decided once from the source's probed audio streams.
+
+    The audio is encoded a single time, when the clip is cut (split_video). Every later stage
+    (convert_to_9_16, add_subtitles) stream-copies it, so there is no generational loss and
+    no repeated downmix of multi-channel tracks.
+    """
+    CODEC = 'aac'
+    BITRATE = '192k'
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    @classmethod
+    def from_source(cls, input_file):
+        plan = cls(get_audio_streams(input_file))
+        log_attribute(f"Audio plan: {plan.describe()}")
+        return plan
+
+    def describe(self):
+        if not self.streams:
+            return "no audio"
+        layouts = ', '.join(f"{s.get('channels', '?')}ch" for s in self.streams)
+        action = "downmix to stereo" if len(self.streams) == 1 else f"mix {len(self.streams)} tracks to stereo"
+        return f"{action} ({layouts}), {self.CODEC} {self.BITRATE}"
+
+    def filter(self, output_label='aout', input_index=0):
+        """filter_complex chain that turns the source's audio streams into one stereo stream [output_label]."""
+        if not self.streams:
+            return None
+        # aformat downmixes (or upmixes) every track to stereo with ffmpeg's standard matrix
+        chains = [f"[{input_index}:a:{n}]aformat=channel_layouts=stereo[a{n}]" for n in range(len(self.streams))]
+        if len(self.streams) == 1:
+            return f"[{input_index}:a:0]aformat=channel_layouts=stereo[{output_label}]"
+        inputs = ''.join(f"[a{n}]" for n in range(len(self.streams)))
+        return ';'.join(chains) + f";{inputs}amix=inputs={len(self.streams)}:duration=longest:normalize=0[{output_label}]"
+
+    def encode_args(self, output_label='aout'):
+        """Output options that map [output_label] and encode it the one time it is encoded."""
+        if not self.streams:
+            return ['-an']
+        return ['-map', f'[{output_label}]', '-c:a', self.CODEC, '-b:a', self.BITRATE, '-ac', '2']
 
 def merge_audio_tracks(input_file, output_file):
     # Count audio streams
@@ -53,114 +149,211 @@ def merge_audio_tracks(input_file, output_file):
     log_attribute(f"Audio tracks merged. Output saved as {output_file}")
     return output_file
 
-def old_time_to_seconds(time_str):
-    """Convert time string to seconds, handling both dot and comma as decimal separators."""
-    time_str = time_str.replace(',', '.')  # Replace comma with dot for proper float conversion
-    parts = time_str.split(':')
-    if len(parts) == 3:
-        h, m, s = parts
-    elif len(parts) == 2:
-        h = '0'
-        m, s = parts
+def segment_window(segment):
+    """Return (start seconds, duration) for a decided segment, capped at 59 seconds."""
+    timestamp = segment['timestamp']
+    start_seconds, end_seconds = parse_timestamp(timestamp)
+    duration = end_seconds - start_seconds
+
+    # Ensure duration is less than or equal to 59 seconds
+    if duration > 59:
+        duration = 59
+
+    return start_seconds, duration
+
+# Encoders used to re-encode the partial GOP at the head of a clip, by source codec. The head
+# has to match the copied rest of the clip, so other codecs are cut by re-encoding the whole clip.
+HEAD_ENCODERS = {
+    'h264': ('libx264', 'h264_mp4toannexb'),
+    'hevc': ('libx265', 'hevc_mp4toannexb'),
+}
+KEYFRAME_TOLERANCE = 0.05  # A clip starting this close to a keyframe is copied as is
+
+def keyframe_index(input_file, cache_file=None):
+    """Times (seconds) of every video keyframe in input_file, read from the packet index with
+    ffprobe (no decoding). Cached in cache_file, keyed by the source's size and mtime."""
+    stat = os.stat(input_file)
+    source = {"size": stat.st_size, "mtime": stat.st_mtime}
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cached = json.load(f)
+            if cached.get('source') == source:
+                log_attribute(f"Using cached keyframe index: {cache_file}")
+                return cached['keyframes']
+        except (OSError, json.JSONDecodeError, KeyError):
+            pass
+
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', input_file]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    # ffmpeg's -ss counts from the start of the file, packet times from the container's epoch
+    start_time = float(get_video_info(input_file)['format'].get('start_time', 0) or 0)
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time) - start_time)
+    keyframes.sort()
+    log_attribute(f"Indexed {len(keyframes)} keyframes in {input_file}")
+
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+        with open(cache_file, 'w') as f:
+            json.dump({"source": source, "keyframes": keyframes}, f)
+    return keyframes
+
+def preceding_keyframe(keyframes, t):
+    """The last keyframe at or before t (where a stream-copy cut starting at t really starts)."""
+    n = bisect.bisect_right(keyframes, t + 1e-3)
+    return keyframes[n - 1] if n else 0.0
+
+def smart_cut(input_file, output_file, start_seconds, duration, keyframes, codec, audio_plan=None):
+    """Frame-accurate cut that re-encodes only the head of the clip.
+
+    The frames from start_seconds up to the next keyframe are re-encoded; everything from that
+    keyframe on is stream-copied whole GOPs at a time. The two parts are joined with the concat
+    demuxer (as MPEG-TS, so the parameter sets travel in-band) and the audio is muxed from the source.
+    """
+    end_seconds = start_seconds + duration
+    cut = next((k for k in keyframes if k >= start_seconds - KEYFRAME_TOLERANCE), None)
+    base = os.path.splitext(output_file)[0]
+    parts = []
+
+    if codec not in HEAD_ENCODERS or cut is None or cut >= end_seconds:
+        # No keyframe inside the clip (or no matching encoder): re-encode the whole video
+        video_cmd = ['ffmpeg', '-y', '-v', 'error', '-ss', str(start_seconds), '-i', input_file, '-t', str(duration),
+                     '-map', '0:v:0', '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '18', '-f', 'mpegts', f"{base}_head.ts"]
+        subprocess.run(video_cmd, check=True)
+        parts.append(f"{base}_head.ts")
     else:
-        raise ValueError(f"Invalid time format: {time_str}")
-    return int(h) * 3600 + int(m) * 60 + float(s)
+        encoder, bsf = HEAD_ENCODERS[codec]
+        if cut - start_seconds > KEYFRAME_TOLERANCE:
+            head_cmd = ['ffmpeg', '-y', '-v', 'error', '-ss', str(start_seconds), '-i', input_file, '-t', str(cut - start_seconds),
+                        '-map', '0:v:0', '-c:v', encoder, '-preset', 'ultrafast', '-crf', '18', '-f', 'mpegts', f"{base}_head.ts"]
+            subprocess.run(head_cmd, check=True)
+            parts.append(f"{base}_head.ts")
+        # Seeking a hair past the keyframe still lands on it (copy mode starts at the keyframe before)
+        tail_cmd = ['ffmpeg', '-y', '-v', 'error', '-ss', str(cut + 0.001), '-i', input_file, '-t', str(end_seconds - cut),
+                    '-map', '0:v:0', '-c:v', 'copy', '-bsf:v', bsf, '-f', 'mpegts', f"{base}_tail.ts"]
+        subprocess.run(tail_cmd, check=True)
+        parts.append(f"{base}_tail.ts")
 
-def time_to_seconds(time_str):
-    """Convert time string to seconds, handling dot, comma, and frame-based timestamps."""
-    
-    # Check if the timestamp contains a frame count (format: HH:MM:SS:FF)
-    frame_pattern = r"(\d{2}):(\d{2}):(\d{2}):(\d{2})"
-    match_frame = re.match(frame_pattern, time_str)
-    if match_frame:
-        h, m, s, frames = map(int, match_frame.groups())
-        # Assuming 30 frames per second (you can adjust this depending on your use case)
-        frames_to_seconds = frames / 30.0
-        return h * 3600 + m * 60 + s + frames_to_seconds
-
-    # Handle the case for milliseconds with a dot or comma separator (HH:MM:SS.mmm or HH:MM:SS,mmm)
-    time_str = time_str.replace(',', '.')  # Normalize comma to dot for float compatibility
-    parts = time_str.split(':')
-    
-    if len(parts) == 3:
-        h, m, s = parts[0], parts[1], parts[2]
-    elif len(parts) == 2:
-        h = '0'  # Handle case where hours are omitted (MM:SS.mmm)
-        m, s = parts[0], parts[1]
+    concat_list = f"{base}_parts.txt"
+    with open(concat_list, 'w') as f:
+        f.writelines(f"file '{os.path.abspath(part)}'\n" for part in parts)
+
+    if audio_plan is not None and audio_plan.streams:
+        audio_args = ['-filter_complex', audio_plan.filter(input_index=1), *audio_plan.encode_args()]
     else:
-        raise ValueError(f"Invalid time format: {time_str}")
+        audio_args = ['-map', '1:a:0?', '-c:a', 'copy']
+    cmd = [
+        'ffmpeg', '-y',
+        '-f', 'concat', '-safe', '0', '-i', concat_list,
+        '-ss', str(start_seconds), '-t', str(duration), '-i', input_file,
+        '-map', '0:v:0',
+        '-c:v', 'copy',
+        *audio_args,
+        '-t', str(duration),
+        output_file
+    ]
+    try:
+        subprocess.run(cmd, check=True)
+    finally:
+        for path in parts + [concat_list]:
+            if os.path.exists(path): os.remove(path)
+
+    copied = end_seconds - cut if parts[-1].endswith('_tail.ts') else 0.0
+    log_attribute(f"Smart cut: re-encoded {duration - copied:.2f}s, copied {copied:.2f}s")
 
-    # Handle seconds and milliseconds
-    s_parts = s.split('.')
-    seconds = int(s_parts[0])
-    milliseconds = float(f"0.{s_parts[1]}") if len(s_parts) == 2 else 0
+def split_video(input_file, output_dir, segments, audio_plan=None, keyframes=None):
+    """Split video into segments based on given timeframes.
 
-    return int(h) * 3600 + int(m) * 60 + seconds + milliseconds
+    If an AudioPlan is given, the clip's final stereo audio is mixed and encoded here, on the
+    few seconds being cut, straight from the source's tracks. That avoids writing a merged
+    copy of the whole video first (see merge_audio_tracks).
 
-def split_video(input_file, output_dir, segments):
-    """Split video into segments based on given timeframes."""
+    If a keyframe index is given (see keyframe_index), clips are cut frame-accurately with
+    smart_cut instead of starting at the keyframe before their start.
+    """
     os.makedirs(output_dir, exist_ok=True)
-    
+    if keyframes is not None:
+        codec = next((s['codec_name'] for s in get_video_info(input_file)['streams'] if s['codec_type'] == 'video'), None)
+
     for i, segment in enumerate(segments):
-        timestamp = segment['timestamp']
-        start_str, end_str = timestamp.strip('[]').split(' --> ')
-        start_seconds = time_to_seconds(start_str)
-        end_seconds = time_to_seconds(end_str)
-        duration = end_seconds - start_seconds
-        
-        # Ensure duration is less than or equal to 59 seconds
-        if duration > 59:
-            duration = 59
-            end_seconds = start_seconds + duration
-            end_str = f"{int(end_seconds//3600):02d}:{int((end_seconds%3600)//60):02d}:{end_seconds%60:.3f}"
+        start_seconds, duration = segment_window(segment)
         
         output_file = os.path.join(output_dir, f"segment_{i+1}.mp4")
         
-        cmd = [
-            'ffmpeg',
-            '-ss', str(start_seconds),
-            '-i', input_file,
-            '-t', str(duration),
-            '-c', 'copy',  # Use copy mode for speed
-            '-avoid_negative_ts', '1',
-            output_file
-        ]
-        
-        subprocess.run(cmd, check=True)
+        if keyframes is not None:
+            smart_cut(input_file, output_file, start_seconds, duration, keyframes, codec, audio_plan)
+        else:
+            if audio_plan is not None and audio_plan.streams:
+                codec_args = [
+                    '-filter_complex', audio_plan.filter(),
+                    '-map', '0:v:0',
+                    '-c:v', 'copy',  # Video is still copied; only the audio is mixed and encoded
+                    *audio_plan.encode_args(),
+                ]
+            else:
+                codec_args = ['-c', 'copy']  # Use copy mode for speed
+
+            cmd = [
+                'ffmpeg',
+                '-ss', str(start_seconds),
+                '-i', input_file,
+                '-t', str(duration),
+                *codec_args,
+                '-avoid_negative_ts', '1',
+                output_file
+            ]
+
+            subprocess.run(cmd, check=True)
         log_attribute(f"Created segment {i+1}: {output_file}")
-        
-        # Save metadata
-        input_base_name = os.path.splitext(os.path.basename(input_file))[0]
-        with open(os.path.join(output_dir, f"{input_base_name}_segment_{i+1}_metadata.txt"), 'w') as f:
-            f.write(f"Video: {input_file}\n")
-            f.write(f"Title: {segment.get('title', '')}\n")
-            f.write(f"Description: {segment.get('description', '')}\n")
-            f.write(f"Content: {segment.get('content', '')}\n")
-            f.write(f"Virality Score: {segment.get('virality', '')}\n")
+        write_segment_metadata(input_file, output_dir, i + 1, segment)
+
+def write_segment_metadata(input_file, output_dir, number, segment):
+    """Save the LLM's title, description and score next to the clip."""
+    input_base_name = os.path.splitext(os.path.basename(input_file))[0]
+    with open(os.path.join(output_dir, f"{input_base_name}_segment_{number}_metadata.txt"), 'w') as f:
+        f.write(f"Video: {input_file}\n")
+        f.write(f"Title: {segment.get('title', '')}\n")
+        f.write(f"Description: {segment.get('description', '')}\n")
+        f.write(f"Content: {segment.get('content', '')}\n")
+        f.write(f"Virality Score: {segment.get('virality', '')}\n")
 
 def parse_segments(segment_file):
     """Parse JSON file into a list of segments."""
     with open(segment_file, 'r') as file:
         data = file.read()
-    
-    # Find all JSON objects in the text
-    json_objects = re.findall(r'\{.*?\}', data, re.DOTALL)
-    segments = []
-    for obj_str in json_objects:
-        try:
-            obj = json.loads(obj_str)
-            segments.append(obj)
-        except json.JSONDecodeError as e:
-            log_error(f"Error parsing JSON object: {e}")
-            continue
-    return segments
 
-def convert_to_9_16(input_file, output_file):
+    try:
+        segments = json.loads(data)
+        if isinstance(segments, list):
+            return [segment for segment in segments if isinstance(segment, dict)]
+    except json.JSONDecodeError as e:
+        log_warning(f"{segment_file} is not a valid JSON array ({e}), salvaging the objects in it")
+
+    # Older or hand-edited decision files: keep every object that decodes on its own
+    return salvage_objects(data)
+
+# Encoder settings of the final 9:16 video
+VIDEO_ENCODE_ARGS = ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23']
+
+SUBTITLE_STYLE = {
+    "align": "2",
+    "font_name": "MADE TOMMY",
+    "font_size": "15",
+    "margin_v": 70,
+}
+
+def video_size(input_file):
+    """(width, height) of the first video stream."""
     info = get_video_info(input_file)
-    width = int(info['streams'][0]['width'])
-    height = int(info['streams'][0]['height'])
+    stream = next(s for s in info['streams'] if s['codec_type'] == 'video')
+    return int(stream['width']), int(stream['height'])
 
-    target_width, target_height = 1080, 1920
+def vertical_filter(width, height, target_width=1080, target_height=1920):
+    """scale/pad filter that letterboxes a width x height video into a 9:16 frame."""
     scale_factor = min(target_width / width, target_height / height)
     scaled_width = int(width * scale_factor)
     scaled_height = int(height * scale_factor)
@@ -168,24 +361,178 @@ def convert_to_9_16(input_file, output_file):
     pad_x = (target_width - scaled_width) // 2
     pad_y = (target_height - scaled_height) // 2
 
-    filter_complex = f'scale={scaled_width}:{scaled_height}:force_original_aspect_ratio=decrease,pad={target_width}:{target_height}:{pad_x}:{pad_y}:color=black'
+    return f'scale={scaled_width}:{scaled_height}:force_original_aspect_ratio=decrease,pad={target_width}:{target_height}:{pad_x}:{pad_y}:color=black'
+
+def subtitle_filter(subtitle_file, options=SUBTITLE_STYLE):
+    """subtitles filter that burns subtitle_file in with the clip style."""
+    return f"subtitles={subtitle_file}:force_style='Alignment={options['align']},Fontname={options['font_name']},Fontsize={options['font_size']},MarginV={options['margin_v']}'"
+
+def convert_to_9_16(input_file, output_file):
+    filter_complex = vertical_filter(*video_size(input_file))
 
     cmd = [
         'ffmpeg',
         '-i', input_file,
         '-vf', filter_complex,
-        '-c:a', 'copy',
-        '-c:v', 'libx264',
-        '-preset', 'ultrafast',
-        '-crf', '23',
-        '-ac', '2',  # Downmix to 2 audio channels
-        '-c:a', 'aac',  # Re-encode the audio to AAC (or use 'copy' if you want the original codec)
-        '-b:a', '128k',  # Set the audio bitrate to 128 kbps (optional, can adjust as needed)
+        *VIDEO_ENCODE_ARGS,
+        '-c:a', 'copy',  # Audio was mixed to stereo and encoded once in split_video (AudioPlan)
+        output_file
+    ]
+
+    subprocess.run(cmd, check=True)
+
+def render_clip(input_file, output_file, start_seconds, duration, subtitle_file, audio_plan=None, size=None, threads=None):
+    """Cut, convert to 9:16 and burn in subtitles with one decode and one encode of the source.
+
+    Seeking before the input is frame-accurate when re-encoding and restarts the timestamps at
+    zero, so the clip's SRT (timed from the clip start) lines up as it does on a cut segment.
+    Pass size (width, height) to skip probing the source for every clip, and threads to cap
+    the threads of the decoder, the filters and the encoder.
+    """
+    width, height = size or video_size(input_file)
+    graph = f"[0:v:0]{vertical_filter(width, height)},{subtitle_filter(subtitle_file)}[vout]"
+    if audio_plan is not None and audio_plan.streams:
+        graph += ';' + audio_plan.filter()
+        audio_args = audio_plan.encode_args()
+    else:
+        audio_args = ['-map', '0:a:0?', '-c:a', 'copy']
+
+    cmd = [
+        'ffmpeg', '-y',
+        *thread_args(threads),
+        '-ss', str(start_seconds),
+        *(['-threads', str(threads)] if threads else []),  # Decoder
+        '-i', input_file,
+        '-t', str(duration),
+        '-filter_complex', graph,
+        '-map', '[vout]',
+        *VIDEO_ENCODE_ARGS,
+        *(['-threads', str(threads)] if threads else []),  # Encoder
+        *audio_args,
         output_file
     ]
 
     subprocess.run(cmd, check=True)
 
+# Cost model for render_clips. Starting a separate ffmpeg costs about SEEK_COST_SECONDS of decoding
+# (process start, seek, decoding up to the first frame); sharing one decode costs decoding the gaps
+# between clips. Groups are also capped so one process does not hold too many encoders at once.
+SEEK_COST_SECONDS = 10
+MAX_CLIPS_PER_RENDER = 6
+
+def group_clips(clips):
+    """Group (output_file, start, duration, subtitle_file) clips, sorted by start, into runs that
+    are cheaper to render from one shared decode than from one process per clip."""
+    groups = []
+    for clip in sorted(clips, key=lambda c: c[1]):
+        if groups and len(groups[-1]) < MAX_CLIPS_PER_RENDER:
+            group = groups[-1]
+            group_end = max(c[1] + c[2] for c in group)
+            # Decoding the gap to this clip (nothing if it overlaps) vs. seeking to it separately
+            if clip[1] - group_end <= SEEK_COST_SECONDS:
+                group.append(clip)
+                continue
+        groups.append([clip])
+    return groups
+
+def thread_args(threads):
+    """Global options that cap ffmpeg's filter graph threads (the decoder and the encoders
+    take their own -threads)."""
+    if not threads:
+        return []
+    return ['-filter_threads', str(threads), '-filter_complex_threads', str(threads)]
+
+def render_group(input_file, group, audio_plan=None, size=None, threads=None):
+    """Render several clips from one seek and one decode of the source: the decoded video (and
+    the mixed audio) is split into one trim/atrim branch per clip, each scaled to 9:16, with its
+    subtitles burned in, and encoded to its own output. threads is shared between the encoders."""
+    width, height = size or video_size(input_file)
+    group_start = min(c[1] for c in group)
+    group_end = max(c[1] + c[2] for c in group)
+    has_audio = audio_plan is not None and bool(audio_plan.streams)
+    n = len(group)
+
+    graph = [f"[0:v:0]split={n}" + ''.join(f"[vs{k}]" for k in range(n))]
+    if has_audio:
+        graph.append(audio_plan.filter(output_label='amixed'))
+        graph.append(f"[amixed]asplit={n}" + ''.join(f"[as{k}]" for k in range(n)))
+
+    outputs = []
+    for k, (output_file, start, duration, subtitle_file) in enumerate(group):
+        offset = start - group_start  # Timestamps restart at zero after the input seek
+        graph.append(f"[vs{k}]trim=start={offset}:duration={duration},setpts=PTS-STARTPTS,"
+                     f"{vertical_filter(width, height)},{subtitle_filter(subtitle_file)}[vout{k}]")
+        outputs += ['-map', f'[vout{k}]', *VIDEO_ENCODE_ARGS]
+        if threads:
+            outputs += ['-threads', str(max(1, threads // n))]
+        if has_audio:
+            graph.append(f"[as{k}]atrim=start={offset}:duration={duration},asetpts=PTS-STARTPTS[aout{k}]")
+            outputs += audio_plan.encode_args(output_label=f'aout{k}')
+        else:
+            outputs += ['-an']
+        outputs.append(output_file)
+
+    cmd = [
+        'ffmpeg', '-y',
+        *thread_args(threads),
+        '-ss', str(group_start),
+        '-t', str(group_end - group_start),
+        *(['-threads', str(threads)] if threads else []),  # Decoder
+        '-i', input_file,
+        '-filter_complex', ';'.join(graph),
+        *outputs
+    ]
+
+    subprocess.run(cmd, check=True)
+
+def render_clips(input_file, clips, audio_plan=None, size=None, workers=1, share_decode=True):
+    """Render (output_file, start, duration, subtitle_file) clips, up to `workers` ffmpeg runs at a
+    time with the CPU cores divided between them.
+
+    With share_decode, clips close together in the timeline share one decode of the source (see
+    group_clips); otherwise every clip is its own render_clip run. If a shared run fails, its
+    clips are retried one by one, so one bad clip (e.g. a broken SRT) only fails itself.
+    A failed clip is logged and does not stop the others. Returns the [(output_file, error)]
+    of the clips that failed.
+    """
+    size = size or video_size(input_file)
+    groups = group_clips(clips) if share_decode else [[clip] for clip in clips]
+    workers = max(1, min(workers, len(groups)))
+    threads = max(1, (os.cpu_count() or 1) // workers) if workers > 1 else None
+    log_info(f"Rendering {len(clips)} clips in {len(groups)} ffmpeg runs, {workers} at a time"
+             + (f" x {threads} threads" if threads else ""))
+
+    def render_one(clip):
+        output_file, start, duration, subtitle_file = clip
+        try:
+            render_clip(input_file, output_file, start, duration, subtitle_file, audio_plan, size, threads)
+        except (subprocess.CalledProcessError, OSError) as e:
+            log_error(f"Failed to render {output_file}: {e}")
+            # Do not leave a half-written clip behind
+            if os.path.exists(output_file): os.remove(output_file)
+            return [(output_file, e)]
+        log_attribute(f"Rendered {output_file} ({start:.2f}s, {duration:.2f}s)")
+        return []
+
+    def render(group):
+        """Render a group and return the failures of its clips."""
+        if len(group) == 1:
+            return render_one(group[0])
+        try:
+            render_group(input_file, group, audio_plan, size, threads)
+        except (subprocess.CalledProcessError, OSError) as e:
+            log_warning(f"Shared render of {len(group)} clips failed ({e}), rendering them one by one")
+            return [failure for clip in group for failure in render_one(clip)]
+        for output_file, start, duration, _ in group:
+            log_attribute(f"Rendered {output_file} ({start:.2f}s, {duration:.2f}s)")
+        return []
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in as_completed([pool.submit(render, group) for group in groups]):
+            failures += future.result()
+    return failures
+
 def get_video_info(input_file):
     cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', input_file]
     result = subprocess.run(cmd, capture_output=True, text=True)
@@ -193,21 +540,12 @@ def get_video_info(input_file):
 
 
 def add_subtitles(input_video, subtitle_file, output_video, subtitle_format="srt"):
-    
-    options = {
-        "align": "2",
-        "font_name": "MADE TOMMY",
-        "font_size": "15",
-        "margin_v": 70,
-    }
 
     ffmpeg_cmd = [
         "ffmpeg",
         "-i", input_video,
-        "-vf", f"subtitles={subtitle_file}:force_style='Alignment={options['align']},Fontname={options['font_name']},Fontsize={options['font_size']},MarginV={options['margin_v']}'",
-        '-ac', '2',  # Downmix to 2 audio channels
-        '-c:a', 'aac',  # Re-encode the audio to AAC (or use 'copy' if you want the original codec)
-        '-b:a', '127k',  # Set the audio bitrate to 128 kbps (optional, can adjust as needed)
+        "-vf", subtitle_filter(subtitle_file),
+        '-c:a', 'copy',  # Audio was mixed to stereo and encoded once in split_video (AudioPlan)
         output_video
     ]
 
@@ -216,6 +554,5 @@ def add_subtitles(input_video, subtitle_file, output_video, subtitle_format="srt
 if __name__ == "__main__":
     # Example usage:
     print(time_to_seconds("00:01:32:30"))  # Frame-based timestamp
-    print(time_to_seconds("00:10:52.640"))  # Comma-separated milliseconds
-    print(old_time_to_seconds("00:10:52,640"))  # Comma-separated milliseconds
+    print(time_to_seconds("00:10:52,640"))  # Comma-separated milliseconds
     print(time_to_seconds("00:06:30.680"))  # Dot-separated milliseconds
\ No newline at end of file
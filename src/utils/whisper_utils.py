@@ -1,15 +1,160 @@
+import os
+import json
+from collections import OrderedDict
+
 import whisper
 from utils.log_manager import log_info, log_attribute, log_warning, log_error
 
-def generate_subtitles(audio_file, temp_dir, options = False):
-    log_info("Generating subtitles")
-    model = whisper.load_model("medium.en")
+from utils.asr_backends import get_backend
+
+DEFAULT_MODEL = "medium.en"
+DEFAULT_BACKEND = "whisper"  # See utils/asr_backends.py, e.g. "faster-whisper" for int8 on CPU
+DEFAULT_DEVICE = "cpu"
+MAX_LOADED_MODELS = 1  # How many models may stay resident at once (least recently used is evicted first)
+
+# Process-wide model pool: (backend, model name, device, compute type) -> loaded model
+_model_pool = OrderedDict()
+
+def get_model(model_name=DEFAULT_MODEL, device=DEFAULT_DEVICE, compute_type=None, backend=DEFAULT_BACKEND):
+    """Return a loaded model from the pool, loading it only the first time it is requested."""
+    asr = get_backend(backend)
+    compute_type = compute_type or asr.default_compute_type
+    key = (backend, model_name, device, compute_type)
+    if key in _model_pool:
+        _model_pool.move_to_end(key)
+        log_attribute(f"Reusing loaded model: {backend} {model_name} ({device}, {compute_type})")
+        return _model_pool[key]
+
+    # Make room before loading so two large models never sit in memory at the same time
+    while len(_model_pool) >= MAX_LOADED_MODELS:
+        # Only take the key: keeping the evicted model in a local would stop gc from freeing it
+        evicted_key = next(iter(_model_pool))
+        del _model_pool[evicted_key]
+        log_warning(f"Evicting model from pool: {evicted_key[0]} {evicted_key[1]} ({evicted_key[2]}, {evicted_key[3]})")
+        _release_memory(evicted_key[2])
+
+    log_info(f"Loading model: {backend} {model_name} ({device}, {compute_type})")
+    model = asr.load(model_name, device, compute_type)
+    _model_pool[key] = model
     log_info("Model loaded...")
-    result = model.transcribe(audio_file, verbose=True, language='en', word_timestamps=True, task="transcribe")
-    word_options = {
-        "highlight_words": True,
-        "max_words_per_line": 4
-    }
+    return model
+
+def unload_model(model_name=None, device=None, compute_type=None, backend=None):
+    """Unload matching models from the pool. With no arguments every model is unloaded."""
+    for key in list(_model_pool):
+        bk, name, dev, ctype = key
+        if backend not in (None, bk) or model_name not in (None, name) or device not in (None, dev) or compute_type not in (None, ctype):
+            continue
+        del _model_pool[key]
+        log_attribute(f"Unloaded model: {bk} {name} ({dev}, {ctype})")
+        _release_memory(dev)
+
+def transcribe(audio, model_name=DEFAULT_MODEL, backend=DEFAULT_BACKEND, verbose=None, batch_size=1, initial_prompt=None):
+    """Transcribe an audio file or 16 kHz waveform with the pooled model of the chosen backend."""
+    model = get_model(model_name, backend=backend)
+    return get_backend(backend).transcribe(model, audio, verbose=verbose, batch_size=batch_size, initial_prompt=initial_prompt)
+
+def _release_memory(device):
+    """Give freed model memory back after a model is dropped from the pool."""
+    import gc
+    gc.collect()
+    if device.startswith("cuda"):
+        import torch
+        torch.cuda.empty_cache()
+
+WORD_OPTIONS = {
+    "highlight_words": True,
+    "max_words_per_line": 4
+}
+
+def generate_subtitles(audio_file, temp_dir, options = False, model_name=DEFAULT_MODEL, workers=1, threads_per_worker=None, speech_regions=None, backend=DEFAULT_BACKEND, checkpoint_file=None, streaming=False):
+    log_info("Generating subtitles")
+    if streaming:
+        from utils.transcription_engine import transcribe_stream
+        result = transcribe_stream(audio_file, model_name, backend)
+    elif workers > 1 or speech_regions is not None or checkpoint_file:
+        from utils.transcription_engine import transcribe_parallel
+        result = transcribe_parallel(audio_file, model_name, workers, threads_per_worker, speech_regions, backend, checkpoint_file)
+    else:
+        from utils.audio_utils import load_pcm
+        result = transcribe(load_pcm(audio_file), model_name, backend, verbose=True)
     srt_writer = whisper.utils.get_writer("srt", temp_dir)
-    srt_writer(result, audio_file, word_options if options else None)
-    
\ No newline at end of file
+    srt_writer(result, audio_file, WORD_OPTIONS if options else None)
+    return result
+
+def generate_subtitles_batch(audio_files, temp_dir, model_name=DEFAULT_MODEL, workers=1, threads_per_worker=None, speech_regions_list=None, backend=DEFAULT_BACKEND, batch_size=8, checkpoint_files=None, on_file_done=None):
+    """Transcribe several audio files through one shared model and write an SRT for each as
+    soon as that file is done. on_file_done(index, result) is called after its SRT is written."""
+    from utils.transcription_engine import transcribe_batch
+    log_info(f"Generating subtitles for {len(audio_files)} files")
+    srt_writer = whisper.utils.get_writer("srt", temp_dir)
+
+    def file_done(n, result):
+        srt_writer(result, audio_files[n], None)
+        if on_file_done:
+            on_file_done(n, result)
+
+    return transcribe_batch(audio_files, model_name, workers, threads_per_worker, speech_regions_list, backend, batch_size, checkpoint_files, file_done)
+
+def save_transcript(result, transcript_file):
+    """Save the word-level transcription result so later steps can reuse it."""
+    with open(transcript_file, 'w') as f:
+        json.dump(result, f)
+
+def load_transcript(transcript_file):
+    """Load a word-level transcription result saved by save_transcript."""
+    with open(transcript_file, 'r') as f:
+        return json.load(f)
+
+def slice_transcript(result, start, end):
+    """Cut the words between start and end (in seconds) out of a full transcript,
+    re-timed so that 0 is the start of the clip."""
+    segments = []
+    for segment in result['segments']:
+        if segment['end'] <= start or segment['start'] >= end:
+            continue
+
+        words = []
+        for word in segment.get('words', []):
+            if word['start'] < start or word['start'] >= end:
+                continue
+            words.append({
+                **word,
+                'start': round(word['start'] - start, 3),
+                'end': round(min(word['end'], end) - start, 3),
+            })
+        if not words:
+            continue
+
+        segments.append({
+            **segment,
+            'id': len(segments),
+            'start': words[0]['start'],
+            'end': words[-1]['end'],
+            'text': ''.join(word['word'] for word in words),
+            'words': words,
+        })
+
+    return {
+        'text': ''.join(segment['text'] for segment in segments),
+        'segments': segments,
+        'language': result.get('language', 'en'),
+    }
+
+def write_clip_subtitles(result, start, end, srt_file):
+    """Write highlighted subtitles for one clip window straight from the full transcript."""
+    clip_result = slice_transcript(result, start, end)
+    srt_writer = whisper.utils.get_writer("srt", os.path.dirname(srt_file))
+    srt_writer(clip_result, srt_file, WORD_OPTIONS)
+    log_attribute(f"Wrote {len(clip_result['segments'])} subtitle segments for {start:.2f}s - {end:.2f}s to {srt_file}")
+
+def transcribe_clip(audio_file, start, end, srt_file, model_name=DEFAULT_MODEL, backend=DEFAULT_BACKEND):
+    """Transcribe only one clip window of a long audio file and write its highlighted subtitles.
+    Timestamps come out relative to the clip start."""
+    from utils.audio_utils import load_pcm
+    audio = load_pcm(audio_file, start, end - start)
+    result = transcribe(audio, model_name, backend)
+    srt_writer = whisper.utils.get_writer("srt", os.path.dirname(srt_file))
+    srt_writer(result, srt_file, WORD_OPTIONS)
+    log_attribute(f"Transcribed {start:.2f}s - {end:.2f}s with {model_name} to {srt_file}")
+    return result